@@ -6,9 +6,17 @@ import os
 import logging
 import argparse
 import csv
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
-from scipy import stats, linalg
-from extramodules.embeddings import WordEmbeddings
+from scipy import stats
+from extramodules.embeddings import WordEmbeddings, is_stream
+from extramodules.vocabulary import Vocabulary
+from extramodules.shared import SharedEmbeddings
+from extramodules.pairtable import PairTable
+from extramodules.atomicdir import file_signature, atomic_write
+from extramodules.similarity import embedding_matrix, paired_similarity, knn_statistics, SIMILARITIES
 
 
 def argparser():
@@ -19,6 +27,19 @@ def argparser():
                         help="Path to the embedding model")
     parser.add_argument('-w', '--wordset',
                         help="Path to a wordset used to filter the used embeddings")
+    parser.add_argument('--similarity', default='cosine', choices=SIMILARITIES,
+                        help="Similarity measure: cosine (default), dot, euclidean (negated distance) or csls")
+    parser.add_argument('--csls_k', type=int, default=10,
+                        help="Number of nearest neighbours used by CSLS (default: 10)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of threads used to compute the nearest neighbours of CSLS")
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help="Number of processes computing the predictions of the models. "
+                             "The models are shared with them through shared memory")
+    parser.add_argument('-c', '--checkpoint', nargs='?', const='',
+                        help="Save the predictions of the models and the computed cells in this directory "
+                             "(<output>.ckpt if none is given). A run with the same directory only computes "
+                             "what is missing")
     parser.add_argument('-l', '--logger', default='INFO',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
                         help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
@@ -30,25 +51,107 @@ def argparser():
         raise ValueError("Invalid log level: {}".format(args.logger))
     logging.basicConfig(level=numeric_level)
 
+    if args.checkpoint is not None and any(is_stream(filepath) for filepath in args.embeddings):
+        # The content of streamed models can't be identified, so their predictions can't be reused
+        logging.warning("Streamed models can't be checkpointed: --checkpoint is ignored")
+        args.checkpoint = None
+    elif args.checkpoint == '':
+        args.checkpoint = args.output + ".ckpt"
+
     return args
 
 
-def cosine_similarity(vec1, vec2):
-    return vec1.dot(vec2) / (linalg.norm(vec1) * linalg.norm(vec2))
+def pair_similarities(words1, words2, word2vec, similarity='cosine', knn=None):
+    """ Computes the similarity of every pair of words in one vectorized pass.
+    For CSLS, knn maps each word to its mean similarity to its nearest neighbours.
+
+    Returns:
+      (sims, found): Similarity of each pair and the mask of the pairs whose words are both in the model
+    """
+    matrix1, found1 = embedding_matrix(words1, word2vec)
+    matrix2, found2 = embedding_matrix(words2, word2vec)
+    knn1, knn2 = None, None
+    if knn is not None:
+        knn1 = np.array([knn.get(w1, np.nan) for w1 in words1])
+        knn2 = np.array([knn.get(w2, np.nan) for w2 in words2])
+    found = found1 & found2
+    if matrix1.shape[1] == 0:
+        return np.full(len(words1), np.nan), found
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return paired_similarity(matrix1, matrix2, similarity, knn1, knn2), found
+
+
+def pair_words(dataset):
+    """ Returns the lowercased targets and primes of the pairs of a dataset """
+    words, prime_ids, target_ids, rts = dataset.index()
+    return [words[i] for i in target_ids], [words[i] for i in prime_ids]
+
+
+def model_predictions(dataset, word2vec, similarity='cosine', csls_k=10, jobs=1):
+    """ Computes the similarity of every pair of the dataset according to one model (NaN when a word is missing) """
+    words1, words2 = pair_words(dataset)
+    knn = None
+    if similarity == 'csls':
+        words = sorted(set(words1) | set(words2))
+        knn = dict(zip(words, knn_statistics(words, word2vec, k=csls_k, jobs=jobs)))
+
+    pred, found = pair_similarities(words1, words2, word2vec, similarity, knn)
+    pred[~found] = np.nan
+    return pred
+
+
+def prediction_correlation(pred1, pred2):
+    """ Spearman correlation of the predictions of two models (see model_predictions)
+    on the pairs found by both, that is the pairs where neither prediction is NaN.
+    """
+    common = ~np.isnan(pred1) & ~np.isnan(pred2)
+    return stats.spearmanr(pred1[common], pred2[common])
+
+
+class Checkpoint:
+    """ Predictions of the models and computed cells of a run, stored in a directory.
+
+    The predictions of a model are identified by a key that depends on the model file, the dataset
+    and the options, so that a run with other options or files doesn't reuse them.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.cells_path = os.path.join(directory, "cells.json")
+        os.makedirs(directory, exist_ok=True)
+        self.cells = {}
+        if os.path.exists(self.cells_path):
+            with open(self.cells_path, 'r') as fin:
+                self.cells = json.load(fin)
 
+    def _prediction_path(self, key):
+        return os.path.join(self.directory, key + ".npy")
 
-def emb_correlation(dataset, word2vec1, word2vec2):
-    pred1 = []
-    pred2 = []
-    common_words = set(word2vec1.keys()) & set(word2vec2.keys())
-    for data in dataset:
-        w1 = data[0].lower()
-        w2 = data[1].lower()
-        if w1 in common_words and w2 in common_words:
-            pred1.append(cosine_similarity(word2vec1[w1], word2vec1[w2]))
-            pred2.append(cosine_similarity(word2vec2[w1], word2vec2[w2]))
+    def prediction(self, key):
+        if not os.path.exists(self._prediction_path(key)):
+            return None
+        return np.load(self._prediction_path(key))
 
-    return stats.stats.spearmanr(pred1, pred2)
+    def save_prediction(self, key, pred):
+        atomic_write(self._prediction_path(key), lambda fout: np.save(fout, pred))
+
+    def cell(self, key1, key2):
+        return self.cells.get(key1 + " " + key2)
+
+    def set_cell(self, key1, key2, rho):
+        self.cells[key1 + " " + key2] = rho
+
+    def save_cells(self):
+        atomic_write(self.cells_path, lambda fout: json.dump(self.cells, fout), mode='w')
+
+
+def prediction_key(filepath, dataset_filepath, args):
+    """ Key of the predictions of a model in the checkpoint """
+    options = [file_signature(filepath), file_signature(dataset_filepath), args.similarity]
+    if args.similarity == 'csls':
+        options.append(str(args.csls_k))
+    if args.wordset is not None:
+        options.append(file_signature(args.wordset))
+    return hashlib.sha1("\n".join(options).encode()).hexdigest()[:16]
 
 
 def dump_matrix(output, matrix, embeddings):
@@ -69,30 +172,16 @@ def dump_matrix(output, matrix, embeddings):
 
 
 def load_dataset(filename):
-    header = {}
-    dataset = []
-    with open(filename, "r") as csv_in:
-        csv_reader = csv.reader(csv_in)
-        row = next(csv_reader)
-        for idx, item in enumerate(row):
-            header[item] = idx
-
-        for row in csv_reader:
-            dataset.append(row)
-
-    return dataset, header
+    """ Loads the pair table of a CSV dataset, built and saved next to it by the first call (see PairTable.open) """
+    dataset = PairTable.open(filename)
+    return dataset, dataset.meta['header']
 
 
 def load_wordset(filename):
-    wordset = set()
-    with open(filename, "r") as fin:
-        for line in fin:
-            line = line.rstrip("\r\n")
-            if not line:  # Don't add empty lines to the wordset
-                continue
-            wordset.add(line)
-
-    return wordset
+    """ Loads a wordset from a file with one word per line or from a saved Vocabulary directory """
+    if Vocabulary.is_saved(filename):
+        return Vocabulary.load(filename)
+    return Vocabulary.from_file(filename)
 
 
 def main():
@@ -103,15 +192,63 @@ def main():
     if args.wordset is not None:
         wordset = load_wordset(args.wordset)
 
-    word2vecs = {}
-    for filepath in args.embeddings:
-        word2vecs[filepath] = WordEmbeddings(filepath, wordset=wordset, lowercase=True).load()
+    checkpoint = None
+    if args.checkpoint is not None:
+        checkpoint = Checkpoint(args.checkpoint)
+    keys = [prediction_key(filepath, args.dataset, args) for filepath in args.embeddings]
+
+    preds = {}
+    missing = []
+    for filepath, key in zip(args.embeddings, keys):
+        pred = checkpoint.prediction(key) if checkpoint is not None else None
+        if pred is not None:
+            logging.info("Predictions of '%s' loaded from the checkpoint", filepath)
+            preds[key] = pred
+        else:
+            missing.append((filepath, key))
+
+    def add_prediction(key, pred):
+        preds[key] = pred
+        if checkpoint is not None:
+            checkpoint.save_prediction(key, pred)
+
+    if args.processes > 1:
+        # The models are loaded into shared memory: only their descriptors are sent to the workers.
+        # At most one model per process is in memory: the next one is loaded when a model is done.
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            futures = {}
+            pending = list(reversed(missing))
+            while pending or futures:
+                while pending and len(futures) < args.processes:
+                    filepath, key = pending.pop()
+                    embeddings = WordEmbeddings(filepath, wordset=wordset, lowercase=True)
+                    word2vec = SharedEmbeddings.from_embeddings(embeddings)
+                    future = executor.submit(model_predictions, dataset, word2vec, args.similarity,
+                                             args.csls_k, args.jobs)
+                    futures[future] = (key, word2vec)
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, word2vec = futures.pop(future)
+                    word2vec.close()
+                    add_prediction(key, future.result())
+    else:
+        for filepath, key in missing:
+            word2vec = WordEmbeddings(filepath, wordset=wordset, lowercase=True).load()
+            add_prediction(key, model_predictions(dataset, word2vec, args.similarity, args.csls_k, args.jobs))
+            del word2vec
 
-    corr_matrix = np.zeros((len(args.embeddings), len(args.embeddings)))
-    for i, emb1 in enumerate(args.embeddings):
-        for j, emb2 in enumerate(args.embeddings):
-            rho, p = emb_correlation(dataset, word2vecs[emb1], word2vecs[emb2])
+    n_models = len(args.embeddings)
+    corr_matrix = np.zeros((n_models, n_models))
+    for i, key1 in enumerate(keys):
+        for j, key2 in enumerate(keys):
+            rho = checkpoint.cell(key1, key2) if checkpoint is not None else None
+            if rho is None:
+                rho, p = prediction_correlation(preds[key1], preds[key2])
+                if checkpoint is not None:
+                    checkpoint.set_cell(key1, key2, float(rho))
             corr_matrix[i, j] = rho
+        if checkpoint is not None:
+            checkpoint.save_cells()
 
     dump_matrix(args.output, corr_matrix, args.embeddings)
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding: utf8
+"""
+Monte Carlo estimation of the power of the Steiger test (see corrstats.py).
+
+Samples of n elements are drawn from a trivariate normal distribution whose correlations are
+xy (gold scores and first model), xz (gold scores and second model) and yz (first and second models).
+The power at n is the proportion of samples on which the Steiger test rejects the equality of the
+correlations xy and xz.
+"""
+
+import sys
+import csv
+import time
+import logging
+import argparse
+import numpy as np
+from corrstats import dependent_corr
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('xy', type=float,
+                        help="Correlation between the dataset and the first model")
+    parser.add_argument('xz', type=float,
+                        help="Correlation between the dataset and the second model")
+    parser.add_argument('yz', type=float,
+                        help="Correlation between the two models")
+    parser.add_argument('-n', '--n_elements', type=int, nargs='+', default=[100, 200, 500, 1000, 2000, 5000],
+                        help="Numbers of pairs of words at which the power is estimated")
+    parser.add_argument('-s', '--simulations', type=int, default=10000,
+                        help="Number of simulated samples for each number of pairs (default: 10000)")
+    parser.add_argument('-a', '--alpha', type=float, default=0.05,
+                        help="Significance level of the test (default: 0.05)")
+    parser.add_argument('--one_tailed', action='store_true',
+                        help="Use a one-tailed test (xy > xz, or xy < xz if xz is larger) instead of a two-tailed one")
+    parser.add_argument('--spearman', action='store_true',
+                        help="The correlations are Spearman correlations, as the ones of wordsim.py and corrmatrix.py. "
+                             "The samples are then ranked before computing their correlations.")
+    parser.add_argument('--batch_size', type=int, default=1 << 22,
+                        help="Maximum number of values drawn at once (default: 4194304)")
+    parser.add_argument('--seed', type=int,
+                        help="Seed of the random generator")
+    parser.add_argument('-l', '--logger', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
+    args = parser.parse_args()
+    if any(n <= 3 for n in args.n_elements):
+        parser.error("the Steiger test needs more than 3 elements (--n_elements)")
+    if args.simulations <= 0:
+        parser.error("--simulations must be positive")
+    correlations = (args.xy, args.xz, args.yz)
+    if any(abs(rho) > 1 for rho in correlations):
+        parser.error("the correlations must be between -1 and 1")
+    if args.spearman:
+        correlations = tuple(spearman_to_pearson(rho) for rho in correlations)
+    try:
+        correlation_cholesky(*correlations)
+    except ValueError:
+        parser.error("the correlations xy={}, xz={}, yz={} are not consistent "
+                     "(their matrix is not positive definite)".format(args.xy, args.xz, args.yz))
+
+    numeric_level = getattr(logging, args.logger.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError("Invalid log level: {}".format(args.logger))
+    logging.basicConfig(level=numeric_level)
+
+    return args
+
+
+def spearman_to_pearson(rho):
+    """ Pearson correlation of a bivariate normal distribution with the given Spearman correlation """
+    return 2 * np.sin(np.pi * rho / 6)
+
+
+def correlation_cholesky(xy, xz, yz):
+    """ Cholesky factor of the correlation matrix of (x, y, z) """
+    corr = np.array([[1, xy, xz], [xy, 1, yz], [xz, yz, 1]], dtype=np.float64)
+    try:
+        return np.linalg.cholesky(corr)
+    except np.linalg.LinAlgError:
+        raise ValueError("The correlations xy={}, xz={}, yz={} are not consistent "
+                         "(their matrix is not positive definite)".format(xy, xz, yz))
+
+
+def sample_correlations(cholesky, n, n_sims, rng, spearman=False):
+    """ Draws n_sims samples of n elements and returns the (xy, xz, yz) correlations of each sample """
+    samples = rng.standard_normal((n_sims, n, 3)) @ cholesky.T
+    if spearman:
+        # Continuous samples have no ties: the ranks are a permutation
+        samples = samples.argsort(axis=1).argsort(axis=1).astype(np.float64)
+    samples -= samples.mean(axis=1, keepdims=True)
+    samples /= np.linalg.norm(samples, axis=1, keepdims=True)
+
+    x, y, z = samples[:, :, 0], samples[:, :, 1], samples[:, :, 2]
+    return np.einsum('ij,ij->i', x, y), np.einsum('ij,ij->i', x, z), np.einsum('ij,ij->i', y, z)
+
+
+def steiger_power(xy, xz, yz, n, n_sims=10000, alpha=0.05, twotailed=True, spearman=False,
+                  batch_size=1 << 22, rng=None):
+    """ Estimates the power of the Steiger test for n elements.
+
+    The one-tailed test is the test of xy > xz, or of xy < xz if xz is larger: only the significant
+    samples whose difference has this sign are counted.
+
+    The samples are drawn by batches of at most batch_size values, and the test is applied to
+    all the samples of a batch at once.
+
+    Returns:
+      (power, std_error): Proportion of samples where the test is significant and its standard error
+    """
+    if n <= 3:
+        raise ValueError("The Steiger test needs more than 3 elements")
+    if n_sims <= 0:
+        raise ValueError("The number of simulations must be positive")
+    if rng is None:
+        rng = np.random.default_rng()
+    direction = 1 if xy >= xz else -1
+    if spearman:
+        xy, xz, yz = spearman_to_pearson(xy), spearman_to_pearson(xz), spearman_to_pearson(yz)
+    cholesky = correlation_cholesky(xy, xz, yz)
+
+    sims_per_batch = max(1, batch_size // (3 * n))
+    significant = 0
+    for start in range(0, n_sims, sims_per_batch):
+        r_xy, r_xz, r_yz = sample_correlations(cholesky, n, min(sims_per_batch, n_sims - start), rng, spearman)
+        with np.errstate(invalid='ignore'):
+            t2, p = dependent_corr(r_xy, r_xz, r_yz, n, twotailed=twotailed)
+        rejected = p < alpha
+        if not twotailed:
+            rejected &= np.sign(t2) == direction
+        significant += int(np.count_nonzero(rejected))
+
+    power = significant / n_sims
+    return power, np.sqrt(power * (1 - power) / n_sims)
+
+
+def main():
+    args = argparser()
+    rng = np.random.default_rng(args.seed)
+
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    writer.writerow(["n", "power", "std error"])
+    for n in args.n_elements:
+        start = time.time()
+        power, std_error = steiger_power(args.xy, args.xz, args.yz, n, args.simulations, args.alpha,
+                                         twotailed=not args.one_tailed, spearman=args.spearman,
+                                         batch_size=args.batch_size, rng=rng)
+        logging.debug("n=%d: %.0f simulations/s", n, args.simulations / (time.time() - start))
+        writer.writerow([n, power, std_error])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Incremental build of the SPP datasets and their splits.
+
+The content hashes of the inputs and outputs of every stage are recorded in a state file.
+A stage is only run again if its command, one of its inputs or one of its outputs changed.
+The LDT and NT datasets are built in parallel.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import argparse
+import logging
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from extramodules.atomicdir import atomic_write
+
+
+# Every path is relative to the root of the repository, where the commands are run
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+TOOLS_DIR = os.path.join("data", "tools")
+DATA_DIR = "data"
+
+SPLITS = ["dev_p1", "test_p1", "dev_p2", "test_p2", "train_p2"]
+
+
+class Stage:
+    """ A command with its input and output files """
+    def __init__(self, name, command, inputs, outputs):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+
+
+class BuildState:
+    """ Hashes of the files of every stage of the last successful build.
+
+    The hash of a file is only computed again if its size or modification time changed.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.files = {}
+        if os.path.exists(filepath):
+            with open(filepath, 'r') as fin:
+                state = json.load(fin)
+            self.stages = state['stages']
+            self.files = state['files']
+
+    def hash(self, filepath):
+        fullpath = os.path.join(ROOT_DIR, filepath)
+        if not os.path.exists(fullpath):
+            return None
+        stat = os.stat(fullpath)
+        with self.lock:
+            entry = self.files.get(filepath)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['sha1']
+
+        digest = hashlib.sha1()
+        with open(fullpath, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                digest.update(block)
+        with self.lock:
+            self.files[filepath] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def snapshot(self, stage):
+        return {
+            'command': stage.command,
+            'inputs': {filepath: self.hash(filepath) for filepath in stage.inputs},
+            'outputs': {filepath: self.hash(filepath) for filepath in stage.outputs},
+        }
+
+    def is_up_to_date(self, stage):
+        with self.lock:
+            recorded = self.stages.get(stage.name)
+        return recorded is not None and recorded == self.snapshot(stage)
+
+    def record(self, stage):
+        snapshot = self.snapshot(stage)
+        with self.lock:
+            self.stages[stage.name] = snapshot
+
+    def save(self):
+        with self.lock:
+            atomic_write(self.filepath, lambda fout: json.dump({'stages': self.stages, 'files': self.files},
+                                                                fout, indent=1, sort_keys=True), mode='w')
+
+
+def relative_glob(pattern):
+    paths = glob.glob(os.path.join(ROOT_DIR, pattern))
+    return sorted(os.path.relpath(path, ROOT_DIR) for path in paths)
+
+
+def run_stage(stage, state, force=False):
+    if not force and state.is_up_to_date(stage):
+        logging.info("%s: up to date", stage.name)
+        return
+    logging.info("%s: building...", stage.name)
+    subprocess.run(stage.command, check=True, cwd=ROOT_DIR)
+    state.record(stage)
+    state.save()
+
+
+def dataset_stages(task):
+    """ Returns the dataset stage of a task (ldt or nt) and, for each dataset, the stages that depend on it """
+    raw_inputs = relative_glob(os.path.join(DATA_DIR, "raw", task, "*.csv"))
+    output_base = os.path.join(DATA_DIR, task, task + "_")
+    datasets = [output_base + "200ms.csv", output_base + "1200ms.csv"]
+    create_datasets = os.path.join(TOOLS_DIR, "create_datasets.py")
+
+    stage = Stage("create_datasets:" + task,
+                  ["python3", create_datasets, output_base] + raw_inputs,
+                  raw_inputs + [create_datasets],
+                  datasets)
+
+    folds_dir = os.path.join(DATA_DIR, "folds")
+    folds = relative_glob(os.path.join(folds_dir, "fold_*.csv"))
+    create_splits = os.path.join(TOOLS_DIR, "create_splits.sh")
+    load_folds = os.path.join(TOOLS_DIR, "load_folds.py")
+    build_pair_table = os.path.join(TOOLS_DIR, "build_pair_table.py")
+
+    split_stages = []
+    for dataset in datasets:
+        basename = os.path.splitext(dataset)[0]
+        table = os.path.join(dataset + ".pairs", "meta.json")
+        splits = ["{}.{}.csv".format(basename, split) for split in SPLITS]
+        # The splits are selected from the pair table of the dataset, which is built first
+        split_stages.append([
+            Stage("pair_table:" + os.path.basename(basename),
+                  ["python3", build_pair_table, dataset] + (["--folds"] + folds if folds else []),
+                  [dataset, build_pair_table] + folds,
+                  [table]),
+            Stage("create_splits:" + os.path.basename(basename),
+                  [create_splits, dataset, folds_dir, basename],
+                  [dataset, table, create_splits, load_folds] + folds,
+                  splits + [os.path.join(split + ".pairs", "meta.json") for split in splits]),
+        ])
+
+    return stage, split_stages
+
+
+def run_stages(stages, state, force=False):
+    for stage in stages:
+        run_stage(stage, state, force=force)
+
+
+def build_task(task, state, executor, force=False):
+    stage, split_stages = dataset_stages(task)
+    run_stage(stage, state, force=force)
+    futures = [executor.submit(run_stages, stages, state, force) for stages in split_stages]
+    for future in futures:
+        future.result()
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tasks', nargs='*', default=['ldt', 'nt'],
+                        help="Datasets to build (default: ldt nt)")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Run every stage even if it is up to date")
+    parser.add_argument('-s', '--state', default=os.path.join(ROOT_DIR, DATA_DIR, ".build_state.json"),
+                        help="Path to the file where the state of the build is recorded")
+    parser.add_argument('-l', '--logger', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
+    args = parser.parse_args()
+
+    numeric_level = getattr(logging, args.logger.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError("Invalid log level: {}".format(args.logger))
+    logging.basicConfig(level=numeric_level)
+
+    return args
+
+
+def main():
+    args = argparser()
+
+    state = BuildState(args.state)
+    for task in args.tasks:
+        os.makedirs(os.path.join(ROOT_DIR, DATA_DIR, task), exist_ok=True)
+
+    # The split stages run in their own pool so that the task threads can wait for them
+    with ThreadPoolExecutor(max_workers=len(args.tasks)) as task_executor, \
+            ThreadPoolExecutor(max_workers=2 * len(args.tasks)) as split_executor:
+        futures = [task_executor.submit(build_task, task, state, split_executor, args.force)
+                   for task in args.tasks]
+        for future in futures:
+            future.result()
+
+
+if __name__ == '__main__':
+    main()
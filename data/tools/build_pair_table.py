@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import logging
+from extramodules.pairtable import PairTable, default_table_path
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dataset', nargs='+',
+                        help="CSV datasets with prime, target and rt columns")
+    parser.add_argument('-f', '--folds', nargs='+', default=[],
+                        help="Fold files whose pairs are marked in the tables")
+    parser.add_argument('-l', '--logger', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
+    args = parser.parse_args()
+
+    numeric_level = getattr(logging, args.logger.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError("Invalid log level: {}".format(args.logger))
+    logging.basicConfig(level=numeric_level)
+
+    return args
+
+
+def main():
+    args = argparser()
+
+    for dataset in args.dataset:
+        table = PairTable.from_csv(dataset, args.folds)
+        table.save(default_table_path(dataset))
+        logging.info("%s: %d pairs, %d words", dataset, len(table), len(table.words))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@
 import argparse
 import logging
 from extramodules.embeddings import WordEmbeddings
+from extramodules.vocabulary import Vocabulary
 
 
 def argparser():
@@ -12,6 +13,8 @@ def argparser():
                         help="Path to the embedding model")
     parser.add_argument('-o', '--output',
                         help="Path to the output file")
+    parser.add_argument('-b', '--binary', action='store_true',
+                        help="Save the wordset as a Vocabulary directory (output is required) instead of a text file")
     parser.add_argument('-l', '--logger', default='INFO',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
@@ -27,16 +30,17 @@ def argparser():
 
 def main():
     args = argparser()
-    intersect = None
+    wordsets = []
     for model_filename in args.embeddings:
         # print("Loading '{}'...".format(model_filename), file=sys.stderr)
-        wordset = WordEmbeddings(model_filename, lowercase=True).load_words()
-        if intersect is not None:
-            intersect &= wordset
-        else:
-            intersect = wordset
-
-    if args.output is None:
+        wordsets.append(WordEmbeddings(model_filename, lowercase=True).load_words())
+    intersect = Vocabulary.intersection(*wordsets)
+
+    if args.binary:
+        if args.output is None:
+            raise ValueError("An output directory is needed to save a binary wordset")
+        intersect.save(args.output)
+    elif args.output is None:
         print(*intersect, sep="\n")
     else:
         with open(args.output, "w") as fout:
@@ -0,0 +1,119 @@
+# coding: utf-8
+"""
+Module to write files and publish directories of files (indexes, tables) atomically.
+
+A file is written under a temporary name, unique to the host and the process, and renamed once complete.
+The published path is a symbolic link to a versioned directory next to it. A new version is
+written completely before the link is switched to it with a single rename, so readers find either
+the old or the new version, never a partial or a missing one.
+"""
+
+import os
+import re
+import fcntl
+import shutil
+import socket
+import secrets
+from contextlib import contextmanager
+
+
+def file_signature(path):
+    """ Path, size and modification time of a file, or of every file of a directory (saved Vocabulary,
+    published directory), to detect that a cache is outdated. Stdin ('-') is returned as is.
+    """
+    if path == '-':
+        return path
+    if os.path.isdir(path):
+        return "\n".join(file_signature(os.path.join(path, name)) for name in sorted(os.listdir(path)))
+    stat = os.stat(path)
+    return "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def atomic_write(path, writer, mode='wb'):
+    """ Calls writer with a file opened under a temporary name, then renames it to path.
+    Readers see either the previous file or the whole new one, and concurrent writers never share
+    a temporary file.
+    """
+    tmp_path = "{}.{}.{}.tmp".format(path, socket.gethostname(), os.getpid())
+    try:
+        with open(tmp_path, mode) as fout:
+            writer(fout)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+@contextmanager
+def _locked(dirpath):
+    """ Serializes the processes publishing the same directory.
+    The lock file is removed when the lock is released, so that none is left next to dirpath.
+    """
+    lock_path = dirpath + ".lock"
+    while True:
+        lock = open(lock_path, 'a')
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            # The previous holder may have removed the file while this process was waiting for it
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(lock_path)):
+                break
+        except FileNotFoundError:
+            pass
+        lock.close()
+    try:
+        yield
+    finally:
+        os.unlink(lock_path)
+        lock.close()
+
+
+def _remove_old_versions(dirpath, current):
+    """ Removes the versions of dirpath other than the current one, including the ones of interrupted builds """
+    parent = os.path.dirname(dirpath) or "."
+    pattern = re.compile(re.escape(os.path.basename(dirpath)) + r"\.[0-9a-f]{12}(\.old)?$")
+    for name in os.listdir(parent):
+        if pattern.match(name) and name != current:
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+def publish_directory(dirpath, build):
+    """ Calls build with a new empty directory, then publishes it at dirpath.
+    The previous versions of dirpath are removed: processes that already mapped their files keep them.
+    """
+    dirpath = dirpath.rstrip(os.sep)
+    version_name = "{}.{}".format(os.path.basename(dirpath), secrets.token_hex(6))
+    version_path = os.path.join(os.path.dirname(dirpath), version_name)
+    link_path = version_path + ".link"
+
+    with _locked(dirpath):
+        os.makedirs(version_path)
+        try:
+            build(version_path)
+            if os.path.isdir(dirpath) and not os.path.islink(dirpath):
+                # Plain directory written before the versioned layout: it can't be replaced by a rename
+                os.rename(dirpath, version_path + ".old")
+            os.symlink(version_name, link_path)
+            os.replace(link_path, dirpath)
+        except BaseException:
+            if os.path.lexists(link_path):
+                os.unlink(link_path)
+            shutil.rmtree(version_path, ignore_errors=True)
+            raise
+        _remove_old_versions(dirpath, version_name)
+
+    return version_path
+
+
+def load_directory(dirpath, load):
+    """ Calls load with the current version of a published directory and returns its result.
+    The files are all read from this version, even if dirpath is published again meanwhile. If the version
+    is removed before its files are opened, the newer version is loaded instead.
+    """
+    while True:
+        version_path = os.path.realpath(dirpath)
+        try:
+            return load(version_path)
+        except FileNotFoundError:
+            if os.path.realpath(dirpath) == version_path:
+                raise
@@ -0,0 +1,122 @@
+# coding: utf-8
+"""
+Module with a word frequency index built from the SPP item files (SubFreq column).
+"""
+
+import os
+import csv
+import numpy as np
+from .atomicdir import file_signature, atomic_write
+
+
+def _load_freqs(filepath, word_column, lowercase=True):
+    freqs = {}
+
+    with open(filepath, 'r') as fin:
+        csv_in = csv.DictReader(fin)
+
+        for row in csv_in:
+            if row['SubFreq']:
+                word = row[word_column].lower() if lowercase else row[word_column]
+                freqs[word] = float(row['SubFreq'])
+
+    words = np.array(sorted(freqs), dtype=str)
+    return words, np.array([freqs[word] for word in words], dtype=np.float64)
+
+
+def _lookup(sorted_words, freqs, words):
+    words = np.asarray(words, dtype=str)
+    result = np.full(len(words), np.nan)
+    if len(sorted_words) == 0 or len(words) == 0:
+        return result
+    idx = np.searchsorted(sorted_words, words)
+    idx[idx == len(sorted_words)] = 0
+    found = sorted_words[idx] == words
+    result[found] = freqs[idx[found]]
+    return result
+
+
+class FrequencyIndex:
+    """ Frequencies of the targets and primes stored in sorted arrays.
+    Words are lowercased by default (see `from_csv`).
+
+    Args:
+      target_words (np.ndarray): Sorted targets
+      target_freqs (np.ndarray): Frequencies of the targets
+      prime_words (np.ndarray): Sorted primes
+      prime_freqs (np.ndarray): Frequencies of the primes
+    """
+    def __init__(self, target_words, target_freqs, prime_words, prime_freqs):
+        self.target_words = target_words
+        self.target_freqs = target_freqs
+        self.prime_words = prime_words
+        self.prime_freqs = prime_freqs
+
+    @classmethod
+    def from_csv(cls, target_filepath, prime_filepath, lowercase=True):
+        """ Builds the index from the SPP target and prime item files.
+        Without lowercase, the words are looked up as written in the item files.
+        """
+        target_words, target_freqs = _load_freqs(target_filepath, "TargetWord", lowercase)
+        prime_words, prime_freqs = _load_freqs(prime_filepath, "Prime", lowercase)
+        return cls(target_words, target_freqs, prime_words, prime_freqs)
+
+    @classmethod
+    def load(cls, target_filepath, prime_filepath, cache_path=None, lowercase=True):
+        """ Loads the index from its cache, or builds it and writes the cache if the
+        cache is missing or older than the item files.
+
+        By default, the cache is stored next to the target item file.
+        """
+        if cache_path is None:
+            cache_path = target_filepath + ("" if lowercase else ".cased") + ".freqindex.npz"
+        signature = "{}|{}|{}".format(file_signature(target_filepath), file_signature(prime_filepath), lowercase)
+
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cache:
+                if str(cache['signature']) == signature:
+                    return cls(cache['target_words'], cache['target_freqs'],
+                               cache['prime_words'], cache['prime_freqs'])
+
+        index = cls.from_csv(target_filepath, prime_filepath, lowercase=lowercase)
+        atomic_write(cache_path, lambda fout: np.savez(fout, signature=signature,
+                                                       target_words=index.target_words,
+                                                       target_freqs=index.target_freqs,
+                                                       prime_words=index.prime_words,
+                                                       prime_freqs=index.prime_freqs))
+        return index
+
+    def target_frequencies(self, targets):
+        """ Returns the frequencies of the targets (NaN for unknown targets) """
+        return _lookup(self.target_words, self.target_freqs, targets)
+
+    def prime_frequencies(self, primes):
+        """ Returns the frequencies of the primes (NaN for unknown primes) """
+        return _lookup(self.prime_words, self.prime_freqs, primes)
+
+    def pair_frequencies(self, primes, targets):
+        """ Returns the summed frequency of the target and the prime of each pair (NaN if one of them is unknown) """
+        return self.prime_frequencies(primes) + self.target_frequencies(targets)
+
+
+def frequency_bins(freqs, bins):
+    """ Assigns each frequency to a bin.
+
+    Args:
+      freqs (np.ndarray): Frequencies (NaN for unknown frequencies)
+      bins (int or list): Number of quantile bins or sorted bin edges
+
+    Returns:
+      (bin_ids, edges): Bin of each frequency (-1 for unknown frequencies) and edges of the bins
+    """
+    known = ~np.isnan(freqs)
+    if isinstance(bins, int):
+        edges = np.quantile(freqs[known], np.linspace(0, 1, bins + 1)[1:-1]) if known.any() else np.array([])
+    else:
+        edges = np.asarray(bins, dtype=np.float64)
+
+    bin_ids = np.full(len(freqs), -1, dtype=np.int64)
+    bin_ids[known] = np.searchsorted(edges, freqs[known], side='right')
+
+    edges = np.concatenate(([-np.inf], edges, [np.inf]))
+    return bin_ids, edges
@@ -0,0 +1,247 @@
+# coding: utf-8
+"""
+Module with a compiled, memory-mappable format for the (prime, target, rt) pairs of the SPP datasets.
+"""
+
+import os
+import csv
+import json
+import logging
+import numpy as np
+from .vocabulary import Vocabulary
+from .atomicdir import publish_directory, load_directory, file_signature
+
+
+TABLE_VERSION = 1
+
+
+def _signature_path(signature):
+    return signature.rsplit(':', 2)[0]
+
+
+def default_table_path(filepath):
+    return filepath + ".pairs"
+
+
+def first_occurrence_order(ids):
+    """ Returns the distinct ids in the order of their first occurrence """
+    unique, first = np.unique(ids, return_index=True)
+    return unique[np.argsort(first, kind='stable')]
+
+
+def _load_fold_pairs(fold_files):
+    """ Maps each (prime, target) pair of the fold files to the index of the first fold that contains it """
+    folds = {}
+    for idx, filename in enumerate(fold_files):
+        with open(filename, 'r') as fin:
+            for row in csv.DictReader(fin):
+                folds.setdefault((row['prime'], row['target']), idx)
+    return folds
+
+
+class PairTable:
+    """ Pairs of a dataset with interned words, stored in numpy arrays.
+
+    The words are stored once, as written in the CSV file (words) and lowercased (lower_words):
+    the pairs only hold integer ids. Saved tables are directories of .npy files that are memory-mapped when loaded.
+
+    Args:
+      words (Vocabulary): Words of the dataset, as written in the CSV file
+      lower_words (Vocabulary): Lowercased words of the dataset
+      lower_ids (np.ndarray): Id in lower_words of the lowercased form of each word
+      primes (np.ndarray): Id in words of the prime of each pair
+      targets (np.ndarray): Id in words of the target of each pair
+      rts (np.ndarray): RT of each pair (NaN when missing)
+      rt_texts (Vocabulary): RTs as written in the CSV file
+      rt_ids (np.ndarray): Id in rt_texts of the RT of each pair
+      folds (np.ndarray): Fold of each pair (-1 when the pair is in none of the folds)
+      meta (dict): Header of the CSV file, signatures of the CSV and fold files
+    """
+    def __init__(self, words, lower_words, lower_ids, primes, targets, rts, rt_texts, rt_ids, folds, meta):
+        self.words = words
+        self.lower_words = lower_words
+        self.lower_ids = lower_ids
+        self.primes = primes
+        self.targets = targets
+        self.rts = rts
+        self.rt_texts = rt_texts
+        self.rt_ids = rt_ids
+        self.folds = folds
+        self.meta = meta
+
+    @classmethod
+    def from_csv(cls, filepath, fold_files=None):
+        """ Builds the table of a CSV dataset with prime, target and rt columns.
+        If fold files are given, each pair is assigned to the first fold that contains it.
+        """
+        fold_files = list(fold_files or [])
+        with open(filepath, 'r') as fin:
+            csv_in = csv.DictReader(fin)
+            header = csv_in.fieldnames
+            rows = [(row['prime'], row['target'], row['rt']) for row in csv_in]
+        primes = [row[0] for row in rows]
+        targets = [row[1] for row in rows]
+        rt_texts = [row[2] for row in rows]
+
+        words = Vocabulary.from_words(primes + targets)
+        lower_words = Vocabulary.from_words(word.lower() for word in words)
+        lower_ids = lower_words.positions([word.lower() for word in words])
+
+        rt_vocab = Vocabulary.from_words(rt_texts)
+        rts = np.empty(len(rows), dtype=np.float64)
+        for i, text in enumerate(rt_texts):
+            try:
+                rts[i] = float(text)
+            except ValueError:
+                rts[i] = np.nan
+
+        folds = np.full(len(rows), -1, dtype=np.int64)
+        if fold_files:
+            fold_pairs = _load_fold_pairs(fold_files)
+            folds[:] = [fold_pairs.get((prime, target), -1) for prime, target, rt in rows]
+
+        meta = {
+            'version': TABLE_VERSION,
+            'header': header,
+            'signature': file_signature(filepath),
+            'fold_files': [file_signature(fold_file) for fold_file in fold_files],
+        }
+        return cls(words, lower_words, lower_ids, words.positions(primes), words.positions(targets),
+                   rts, rt_vocab, rt_vocab.positions(rt_texts), folds, meta)
+
+    @classmethod
+    def load(cls, dirpath, mmap=True):
+        """ Loads a table saved with `save`. The arrays are memory-mapped by default. """
+        mmap_mode = 'r' if mmap else None
+
+        def load(version_path):
+            def array(name):
+                return np.load(os.path.join(version_path, name + ".npy"), mmap_mode=mmap_mode)
+
+            return cls(Vocabulary.load(os.path.join(version_path, "words"), mmap=mmap),
+                       Vocabulary.load(os.path.join(version_path, "lower_words"), mmap=mmap),
+                       array("lower_ids"), array("primes"), array("targets"), array("rts"),
+                       Vocabulary.load(os.path.join(version_path, "rt_texts"), mmap=mmap),
+                       array("rt_ids"), array("folds"), cls._read_meta(version_path))
+
+        return load_directory(dirpath, load)
+
+    def save(self, dirpath, source=None):
+        """ Saves the table into a directory of numpy arrays.
+        If source is given, the table is recorded as the table of this CSV file.
+
+        The table is published atomically (see atomicdir.publish_directory): processes loading it
+        concurrently find either the previous table or the new one, never partial files.
+        """
+        if source is not None:
+            self.meta = dict(self.meta, signature=file_signature(source))
+
+        def write(version_path):
+            self.words.save(os.path.join(version_path, "words"))
+            self.lower_words.save(os.path.join(version_path, "lower_words"))
+            self.rt_texts.save(os.path.join(version_path, "rt_texts"))
+            for name in ("lower_ids", "primes", "targets", "rts", "rt_ids", "folds"):
+                np.save(os.path.join(version_path, name + ".npy"), getattr(self, name))
+            with open(os.path.join(version_path, "meta.json"), 'w') as fout:
+                json.dump(self.meta, fout, indent=1)
+
+        publish_directory(dirpath, write)
+
+    @staticmethod
+    def _read_meta(dirpath):
+        with open(os.path.join(dirpath, "meta.json"), 'r') as fin:
+            return json.load(fin)
+
+    @classmethod
+    def saved_meta(cls, dirpath):
+        """ Returns the meta data of the table saved in dirpath, or None if there is none """
+        try:
+            return load_directory(dirpath, cls._read_meta)
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def is_up_to_date(cls, dirpath, filepath, fold_files=None):
+        """ Whether the table saved in dirpath was built from the current CSV file and includes the given folds """
+        meta = cls.saved_meta(dirpath)
+        if meta is None:
+            return False
+        if meta.get('version') != TABLE_VERSION or meta['signature'] != file_signature(filepath):
+            return False
+        return all(file_signature(fold_file) in meta['fold_files'] for fold_file in fold_files or [])
+
+    @classmethod
+    def open(cls, filepath, fold_files=None, table_path=None):
+        """ Loads the table of a CSV dataset, or builds it and saves it next to the dataset if it is missing,
+        older than the dataset or doesn't include the given folds.
+
+        A table is rebuilt with the folds of the saved table that still exist as well as the given ones,
+        so that callers asking for different folds of the same dataset don't rebuild it in turn.
+        """
+        if table_path is None:
+            table_path = default_table_path(filepath)
+        if cls.is_up_to_date(table_path, filepath, fold_files):
+            return cls.load(table_path)
+
+        # The given folds come first: they keep the pairs that are in several folds
+        fold_files = list(fold_files or [])
+        meta = cls.saved_meta(table_path)
+        if meta is not None and meta.get('version') == TABLE_VERSION:
+            requested = {os.path.abspath(fold_file) for fold_file in fold_files}
+            stored = [_signature_path(signature) for signature in meta['fold_files']]
+            fold_files += [path for path in stored if path not in requested and os.path.exists(path)]
+
+        logging.info("Building the pair table of '%s'...", filepath)
+        table = cls.from_csv(filepath, fold_files)
+        # Another process may have saved the table in the meantime
+        if cls.is_up_to_date(table_path, filepath, fold_files):
+            return table
+        try:
+            table.save(table_path)
+        except OSError as e:
+            logging.warning("Can't save the pair table of '%s': %s", filepath, e)
+        return table
+
+    def fold_index(self, fold_files):
+        """ Returns, for each fold of the table, its position in fold_files (-1 for the folds that aren't in it) """
+        signatures = [file_signature(fold_file) for fold_file in fold_files]
+        return np.array([signatures.index(signature) if signature in signatures else -1
+                         for signature in self.meta['fold_files']], dtype=np.int64)
+
+    def pair_folds(self, fold_files):
+        """ Returns the position in fold_files of the fold of each pair (-1 when the pair is in none of them) """
+        index = np.append(self.fold_index(fold_files), -1)
+        # Pairs without fold (-1) are mapped to the last entry
+        return index[np.asarray(self.folds)]
+
+    def subset(self, mask):
+        """ Returns the table of the selected pairs. The vocabularies are shared with this table. """
+        return PairTable(self.words, self.lower_words, self.lower_ids, self.primes[mask], self.targets[mask],
+                         self.rts[mask], self.rt_texts, self.rt_ids[mask], self.folds[mask], dict(self.meta))
+
+    def index(self):
+        """ Maps every pair to integer ids of their lowercased words.
+
+        Returns:
+          (words, prime_ids, target_ids, rts): Lowercased words of the pairs, in the order of their first occurrence,
+          ids of the primes and targets in this list and RTs (NaN when the RT is missing)
+        """
+        prime_ids = np.asarray(self.lower_ids)[self.primes]
+        target_ids = np.asarray(self.lower_ids)[self.targets]
+        interleaved = np.empty(2 * len(prime_ids), dtype=np.int64)
+        interleaved[0::2] = prime_ids
+        interleaved[1::2] = target_ids
+        order = first_occurrence_order(interleaved)
+        rank = np.full(len(self.lower_words), -1, dtype=np.int64)
+        rank[order] = np.arange(len(order))
+
+        words = [self.lower_words[i] for i in order]
+        return words, rank[prime_ids], rank[target_ids], np.asarray(self.rts)
+
+    def __len__(self):
+        return len(self.primes)
+
+    def __iter__(self):
+        """ Yields each pair as a row of the CSV file (dictionary with prime, target and rt) """
+        for prime, target, rt_id in zip(self.primes, self.targets, self.rt_ids):
+            yield {'prime': self.words[prime], 'target': self.words[target], 'rt': self.rt_texts[rt_id]}
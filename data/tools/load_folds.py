@@ -2,7 +2,7 @@
 
 import argparse
 import logging
-import csv
+from extramodules.pairtable import PairTable, default_table_path
 
 
 def argparser():
@@ -23,30 +23,20 @@ def argparser():
     return args
 
 
-def load_folds(folds):
-    pairs = set()
-    for fold in folds:
-        with open(fold, 'r') as fin:
-            csv_fold = csv.DictReader(fin)
-            for line in csv_fold:
-                pairs.add((line['prime'], line['target']))
-    return pairs
-
-
 def main():
     args = argparser()
 
-    pairs = load_folds(args.fold)
-
-    with open(args.dataset, 'r') as fin, open(args.output, 'w') as fout:
-        csv_in = csv.DictReader(fin)
+    table = PairTable.open(args.dataset, fold_files=args.fold)
+    selected = table.subset(table.pair_folds(args.fold) >= 0)
 
+    with open(args.output, 'w') as fout:
         print("target,prime,rt", file=fout)
-        for line in csv_in:
-            if (line['prime'], line['target']) not in pairs:
-                continue
+        for line in selected:
             print("{},{},{}".format(line['target'], line['prime'], line['rt']), file=fout)
 
+    # The table of the split is saved with it, so that its consumers don't parse it again
+    selected.save(default_table_path(args.output), source=args.output)
+
 
 if __name__ == '__main__':
     main()
@@ -3,39 +3,20 @@
 
 import argparse
 import logging
-import csv
+import numpy as np
+from extramodules.freqindex import FrequencyIndex
+from extramodules.pairtable import PairTable
 
 
-def load_freqs(filepath, word_column):
-    freqs = {}
-
-    with open(filepath, 'r') as fin:
-        csv_in = csv.DictReader(fin)
-
-        for row in csv_in:
-            if row['SubFreq']:
-                freqs[row[word_column]] = float(row['SubFreq'])
-
-    return freqs
-
-
-def calculate_mean_freq(filepath, target_freqs, prime_freqs):
-    with open(filepath, 'r') as fin:
-        csv_in = csv.DictReader(fin)
-
-        total_freq = 0
-        n_pairs = 0
-        for row in csv_in:
-            target = row['target']
-            prime = row['prime']
-
-            if target not in target_freqs or prime not in prime_freqs:
-                continue
-
-            n_pairs += 1
-            total_freq += target_freqs[target] + prime_freqs[prime]
-
-    return total_freq / n_pairs
+def calculate_mean_freq(filepath, freq_index, lowercase=False):
+    table = PairTable.open(filepath)
+    if lowercase:
+        words, primes, targets, _ = table.index()
+    else:
+        words, primes, targets = list(table.words), table.primes, table.targets
+    # Each distinct word is looked up once
+    freqs = freq_index.prime_frequencies(words)[primes] + freq_index.target_frequencies(words)[targets]
+    return np.nanmean(freqs)
 
 
 def argparser():
@@ -43,6 +24,10 @@ def argparser():
     parser.add_argument('target_freqs')
     parser.add_argument('prime_freqs')
     parser.add_argument('dataset', nargs='+')
+    parser.add_argument('-c', '--cache',
+                        help="Path to the cache of the frequency index (default: next to target_freqs)")
+    parser.add_argument('--lowercase', action='store_true',
+                        help="Lowercase the words of the datasets and of the item files before looking them up")
     parser.add_argument('-l', '--logger', default='INFO',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
@@ -59,11 +44,11 @@ def argparser():
 def main():
     args = argparser()
 
-    target_freqs = load_freqs(args.target_freqs, "TargetWord")
-    prime_freqs = load_freqs(args.prime_freqs, "Prime")
+    freq_index = FrequencyIndex.load(args.target_freqs, args.prime_freqs, cache_path=args.cache,
+                                     lowercase=args.lowercase)
 
     for dataset in args.dataset:
-        mean_freq = calculate_mean_freq(dataset, target_freqs, prime_freqs)
+        mean_freq = calculate_mean_freq(dataset, freq_index, lowercase=args.lowercase)
         print("{}: {}".format(dataset, mean_freq))
 
 
@@ -4,58 +4,107 @@ import os
 import argparse
 import logging
 import csv
+import functools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from scipy import stats
+from extramodules.pairtable import PairTable, first_occurrence_order
 
 
-def load_other_dataset(filepath):
-    dataset = {}
+def encode_pairs(vocab, words1, words2):
+    """ Encodes each pair of words as a single integer. Pairs with an unknown word are encoded as -1. """
+    ids1 = np.fromiter((vocab.get(word, -1) for word in words1), dtype=np.int64, count=len(words1))
+    ids2 = np.fromiter((vocab.get(word, -1) for word in words2), dtype=np.int64, count=len(words2))
+    codes = ids1 * len(vocab) + ids2
+    codes[(ids1 < 0) | (ids2 < 0)] = -1
+    return codes
+
+
+def first_occurrences(codes, scores):
+    """ Keeps the first score of each pair code and sorts the codes """
+    valid = codes >= 0
+    codes, first = np.unique(codes[valid], return_index=True)
+    return codes, scores[valid][first]
+
+
+def load_other_dataset(filepath, vocab):
+    """ Loads a TSV dataset whose pairs are symmetric. Only the pairs whose words are in vocab are kept.
+
+    Returns:
+      (codes, scores): Sorted pair codes (both directions of each pair) and their scores
+    """
+    words1, words2, scores = [], [], []
     with open(filepath, 'r') as fin:
         for line in fin:
             line = line.rstrip('\r\n')
             tokens = line.split('\t')
-            word1 = tokens[0].lower()
-            word2 = tokens[1].lower()
-            score = float(tokens[2])
-            if (word1, word2) not in dataset:
-                dataset[(word1, word2)] = score
-                dataset[(word2, word1)] = score
+            words1.append(tokens[0].lower())
+            words2.append(tokens[1].lower())
+            scores.append(float(tokens[2]))
+
+    # Both directions of a pair are interleaved so that the first occurrence of the pair is kept
+    codes = np.empty(2 * len(scores), dtype=np.int64)
+    codes[0::2] = encode_pairs(vocab, words1, words2)
+    codes[1::2] = encode_pairs(vocab, words2, words1)
 
-    return dataset
+    return first_occurrences(codes, np.repeat(np.asarray(scores), 2))
 
 
 def load_spp_dataset(filepath):
-    dataset = {}
-    with open(filepath, "r") as csv_in:
-        csv_reader = csv.DictReader(csv_in)
+    """ Loads a SPP dataset from its pair table (see PairTable.open). The pairs without RT are ignored.
+
+    Returns:
+      (vocab, codes, scores): Vocabulary of the dataset, sorted pair codes and their RT
+    """
+    table = PairTable.open(filepath)
+    valid = ~np.isnan(table.rts)
+    prime_ids = np.asarray(table.lower_ids)[table.primes[valid]]
+    target_ids = np.asarray(table.lower_ids)[table.targets[valid]]
+
+    # The words are numbered in the order of their first occurrence, primes first
+    order = first_occurrence_order(np.concatenate((prime_ids, target_ids)))
+    rank = np.full(len(table.lower_words), -1, dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    vocab = {table.lower_words[i]: idx for idx, i in enumerate(order)}
 
-        for row in csv_reader:
-            prime = row['prime'].lower()
-            target = row['target'].lower()
-            if not row['rt']:
-                continue
-            score = float(row['rt'])
-            if (prime, target) not in dataset:
-                dataset[(prime, target)] = score
+    codes = rank[prime_ids] * len(vocab) + rank[target_ids]
+    codes, scores = first_occurrences(codes, table.rts[valid])
 
-    return dataset
+    return vocab, codes, scores
 
 
 def spearman_rho(vec1, vec2):
-    return stats.stats.spearmanr(vec1, vec2)
+    return stats.spearmanr(vec1, vec2)
 
 
-def correlation(spp_dataset, other_dataset, common_pairs):
-    spp_scores = []
-    other_scores = []
+def correlation(spp_codes, spp_scores, other_codes, other_scores):
+    """ Joins the two datasets on their pair codes and computes the Spearman correlation of their scores.
 
-    for pair in common_pairs:
-        spp_scores.append(spp_dataset[pair])
-        other_scores.append(other_dataset[pair])
-        print("{} - {} {}".format(pair, spp_dataset[pair], other_dataset[pair]))
+    Returns:
+      (rho, common, spp_common, other_common): Correlation, codes of the common pairs and their scores in both datasets
+    """
+    common, spp_idx, other_idx = np.intersect1d(spp_codes, other_codes,
+                                                assume_unique=True, return_indices=True)
+    spp_common = spp_scores[spp_idx]
+    other_common = other_scores[other_idx]
 
-    rho, pr = spearman_rho(spp_scores, other_scores)
+    rho, pr = spearman_rho(spp_common, other_common)
 
-    return rho
+    return rho, common, spp_common, other_common
+
+
+def process_other_dataset(filepath, vocab, spp_codes, spp_scores):
+    codes, scores = load_other_dataset(filepath, vocab)
+    return correlation(spp_codes, spp_scores, codes, scores)
+
+
+def dump_pairs(fout, name, vocab, common, spp_common, other_common):
+    words = list(vocab)
+    writer = csv.writer(fout, lineterminator="\n")
+    for code, spp_score, other_score in zip(common, spp_common, other_common):
+        word1, word2 = words[code // len(words)], words[code % len(words)]
+        writer.writerow([name, word1, word2, spp_score, other_score])
 
 
 def argparser():
@@ -64,6 +113,10 @@ def argparser():
                         help="Path to a SPP dataset (CSV format)")
     parser.add_argument('other_dataset', nargs='+',
                         help="Paths to other datasets (TSV format with no header)")
+    parser.add_argument('-p', '--pairs_output',
+                        help="Path to a CSV file where the scores of every common pair are written")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of datasets processed in parallel")
     parser.add_argument('-l', '--logger', default='INFO',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
@@ -80,17 +133,29 @@ def argparser():
 def main():
     args = argparser()
 
-    spp_dataset = load_spp_dataset(args.spp_dataset)
-
-    print("dataset,rho,n_common")
-    for other_dataset_name in args.other_dataset:
-        other_dataset = load_other_dataset(other_dataset_name)
-        common_pairs = spp_dataset.keys() & other_dataset.keys()
-
-        rho = correlation(spp_dataset, other_dataset, common_pairs)
-
-        name = os.path.splitext(os.path.basename(other_dataset_name))[0]
-        print("{},{},{}".format(name, rho, len(common_pairs)))
+    vocab, spp_codes, spp_scores = load_spp_dataset(args.spp_dataset)
+
+    process = functools.partial(process_other_dataset, vocab=vocab,
+                                spp_codes=spp_codes, spp_scores=spp_scores)
+    # The workers and the pairs file are closed even if a dataset fails
+    with contextlib.ExitStack() as stack:
+        if args.jobs > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=args.jobs))
+            results = executor.map(process, args.other_dataset)
+        else:
+            results = map(process, args.other_dataset)
+
+        pairs_out = None
+        if args.pairs_output is not None:
+            pairs_out = stack.enter_context(open(args.pairs_output, 'w'))
+            print("dataset,word1,word2,spp_score,other_score", file=pairs_out)
+
+        print("dataset,rho,n_common")
+        for other_dataset_name, (rho, common, spp_common, other_common) in zip(args.other_dataset, results):
+            name = os.path.splitext(os.path.basename(other_dataset_name))[0]
+            print("{},{},{}".format(name, rho, len(common)))
+            if pairs_out is not None:
+                dump_pairs(pairs_out, name, vocab, common, spp_common, other_common)
 
 
 if __name__ == '__main__':
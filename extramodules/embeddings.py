@@ -4,125 +4,425 @@ Module that allows to easily load embeddings.
 """
 
 import os
+import io
+import sys
+import stat
 import logging
 import gzip
+import json
+import hashlib
+from collections.abc import Mapping
 import numpy as np
 import tqdm
+from .vocabulary import Vocabulary
+from .atomicdir import publish_directory, load_directory, file_signature, atomic_write
 
 
-class WordEmbeddings:
+def _open(filepath):
+    if filepath.endswith(".gz"):
+        return gzip.open(filepath, 'rt')
+    return open(filepath, 'r')
+
+
+def is_stream(filepath):
+    """ Whether the embeddings are read from stdin ('-') or a named pipe, which can only be read once """
+    return filepath == '-' or stat.S_ISFIFO(os.stat(filepath).st_mode)
+
+
+def _open_stream(filepath):
+    """ Opens stdin ('-') or a named pipe as text. Gzipped streams are detected from their first bytes,
+    which are peeked without being consumed.
+    """
+    if filepath == '-':
+        fin = open(sys.stdin.fileno(), 'rb', closefd=False)
+    else:
+        fin = open(filepath, 'rb')
+    if fin.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.open(fin, 'rt')
+    return io.TextIOWrapper(fin)
+
+
+class _LineStream:
+    """ Lines of stdin or of a named pipe. The first line is read ahead to sniff the format of the embeddings,
+    and is given back when the lines are iterated. The lines can only be iterated once.
+    """
+    def __init__(self, filepath):
+        self.fin = _open_stream(filepath)
+        self.first_line = self.fin.readline()
+        self.consumed = False
+
+    def __iter__(self):
+        if self.consumed:
+            raise ValueError("The embeddings of a stream can only be read once")
+        self.consumed = True
+        if self.first_line:
+            yield self.first_line
+        yield from self.fin
+
+    def close(self):
+        self.fin.close()
+
+
+def _parse_vectors(vectors, dim):
+    """ Parses a list of space-separated vectors with a single numpy call """
+    return np.array(" ".join(vectors).split(), dtype=np.float32).reshape(len(vectors), dim)
+
+
+class _Embeddings:
+    """ Base class of the embedding readers.
+
+    Subclasses implement `_lines`, which yields the (key, vector string) of every valid line of the file.
+    The filter, if any, is stored in `self.keyset`. When it is a Vocabulary, it is applied by chunks.
+    """
+    chunk_size = 50000
+
+    def __init__(self, filepath, keyset=None, lowercase=False, cache_dir=None):
+        self.filepath = filepath
+        self.keyset = keyset
+        self.lowercase = lowercase
+        self.cache_dir = cache_dir
+        self.dim = None
+
+    def _lines(self):
+        raise NotImplementedError
+
+    def _filter_chunk(self, chunk):
+        mask = self.keyset.isin([key for key, vector in chunk])
+        return [record for record, keep in zip(chunk, mask) if keep]
+
+    def _records(self):
+        """ Yields the (key, vector string) of the lines that pass the filter """
+        if self.keyset is None:
+            yield from self._lines()
+        elif not isinstance(self.keyset, Vocabulary):
+            for key, vector in self._lines():
+                if key in self.keyset:
+                    yield key, vector
+        else:
+            chunk = []
+            for record in self._lines():
+                chunk.append(record)
+                if len(chunk) == self.chunk_size:
+                    yield from self._filter_chunk(chunk)
+                    chunk = []
+            if chunk:
+                yield from self._filter_chunk(chunk)
+
+    def __iter__(self):
+        for key, vector in self._records():
+            yield key, np.asarray(vector.split(' '), dtype='float32')
+
+    def _cache_path(self):
+        digest = hashlib.sha1()
+        digest.update("{}\n{}\n{}\n".format(type(self).__name__, file_signature(self.filepath), self.lowercase).encode())
+        if self.keyset is not None:
+            for key in sorted(self.keyset):
+                digest.update(key.encode() + b"\n")
+        basename = os.path.basename(self.filepath)
+        return os.path.join(self.cache_dir, "{}.{}.npz".format(basename, digest.hexdigest()[:16]))
+
+    def load_matrix(self):
+        """ Loads the embedding file into a list of keys and a matrix with one row per key.
+
+        The vectors are parsed by chunks. If a cache directory was given, the result is stored
+        in a binary file that is used instead of the embedding file by the next calls.
+        """
+        cache_path = None
+        if self.cache_dir is not None and not is_stream(self.filepath):
+            cache_path = self._cache_path()
+            if os.path.exists(cache_path):
+                logging.debug("Loading '%s' from cache '%s'", self.filepath, cache_path)
+                with np.load(cache_path) as cache:
+                    return cache['keys'].tolist(), cache['vectors']
+
+        keys, chunks, vectors = [], [], []
+        for key, vector in self._records():
+            keys.append(key)
+            vectors.append(vector)
+            if len(vectors) == self.chunk_size:
+                chunks.append(_parse_vectors(vectors, self.dim))
+                vectors = []
+        if vectors:
+            chunks.append(_parse_vectors(vectors, self.dim))
+        matrix = np.vstack(chunks) if chunks else np.zeros((0, self.dim), dtype=np.float32)
+
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            atomic_write(cache_path, lambda fout: np.savez(fout, keys=np.array(keys, dtype=str), vectors=matrix))
+
+        return keys, matrix
+
+    def load(self):
+        """ Loads the entire embedding file into a dictionary """
+        keys, matrix = self.load_matrix()
+        return dict(zip(keys, matrix))
+
+
+class WordEmbeddings(_Embeddings):
     """ Class that allows you to iterate through the word embeddings in a file.
-    The input file can be gzipped.
+    The input file can be gzipped. It can also be stdin ('-') or a named pipe, which are read in a single pass:
+    the embeddings can then only be iterated or loaded once, and they are not cached.
 
-    Args: 
+    Args:
       filepath (str): Path to the file with word embeddings
-      wordset (set): Set of words to use as a filter. Only words that are in this set will be loaded.
+      wordset (set or Vocabulary): Set of words to use as a filter. Only words that are in this set will be loaded.
+      lowercase (bool): Whether to lowercase the words
+      cache_dir (str): Directory where the loaded embeddings are cached in a binary format
     """
-    def __init__(self, filepath, wordset=None, lowercase=False):
-        self.filepath = filepath
-        self.wordset = wordset
+    def __init__(self, filepath, wordset=None, lowercase=False, cache_dir=None):
+        super().__init__(filepath, keyset=wordset, lowercase=lowercase, cache_dir=cache_dir)
         self._n_embeddings = None
-        self.lowercase = lowercase
-        if filepath.endswith(".gz"):
-            fin = gzip.open(filepath, 'rt')
+        self._stream = None
+        if is_stream(filepath):
+            self._stream = _LineStream(filepath)
+            line = self._stream.first_line
         else:
-            fin = open(filepath, 'r')
+            fin = _open(filepath)
+            line = fin.readline()
+            fin.close()
 
-        line = fin.readline().rstrip(" \r\n")
-        tokens = line.split(' ')
+        tokens = line.rstrip(" \r\n").split(' ')
         if len(tokens) == 2:  # W2V format
             self.dim = int(tokens[1])
             self._n_embeddings = int(tokens[0])
         else:                 # GloVe format
             self.dim = len(tokens) - 1
 
-        fin.close()
+    @property
+    def wordset(self):
+        return self.keyset
 
-    def __iter__(self):
+    @wordset.setter
+    def wordset(self, wordset):
+        self.keyset = wordset
+
+    def _lines(self):
         line_nb = 0
-        if self.filepath.endswith(".gz"):
-            fin = gzip.open(self.filepath, 'rt')
-        else:
-            fin = open(self.filepath, 'r')
+        fin = self._stream if self._stream is not None else _open(self.filepath)
         with tqdm.tqdm(total=self._n_embeddings,
                        desc="Loading '{}' progress".format(self.filepath),
                        unit=" words") as pbar:
             for line in fin:
                 line_nb += 1
                 line = line.rstrip(" \r\n")
-                tokens = line.split(' ')
-                if len(tokens) == 2:  # W2V format
+                n_tokens = line.count(' ') + 1
+                if n_tokens == 2:  # W2V format
                     continue
                 pbar.update(1)
-                if self.dim != len(tokens) - 1:
+                if self.dim != n_tokens - 1:
                     basename = os.path.basename(self.filepath)
                     logging.warning("[%s:%d] Embedding dimension error (%d vs %d) ! Skipping...",
-                                    basename, line_nb, len(tokens) - 1, self.dim)
+                                    basename, line_nb, n_tokens - 1, self.dim)
                     continue
-                word = tokens[0]
+                word, _, vector = line.partition(' ')
                 if self.lowercase:
                     word = word.lower()
-                if self.wordset is not None and word not in self.wordset:
-                    continue
-                coefs = np.asarray(tokens[1:], dtype='float32')
-                yield word, coefs
+                yield word, vector
 
         fin.close()
 
-    def load(self):
-        """ Loads the entire embedding file into a dictionary """
-        embeddings = {}
-        for word, coefs in self:
-            embeddings[word] = coefs
-        return embeddings
-
     def load_words(self):
-        """ Only load the words in the embedding file """
-        words = set()
-        for word, coefs in self:
-            words.add(word)
-        return words
+        """ Only load the words in the embedding file, as a Vocabulary """
+        return Vocabulary.from_words(word for word, vector in self._records())
 
 
-class SentenceEmbeddings:
+class SentenceEmbeddings(_Embeddings):
     """ Class that allows you to iterate through the sentence embeddings in a file.
-    The input file can be gzipped.
+    Each line contains a sentence and its vector separated by a tab.
+    The input file can be gzipped. As with WordEmbeddings, it can also be stdin ('-') or a named pipe.
 
-    Args: 
+    Args:
       filepath (str): Path to the file with word embeddings
+      lowercase (bool): Whether to lowercase the sentences
+      sentenceset (set): Set of sentences to use as a filter. Only sentences that are in this set will be loaded.
+      cache_dir (str): Directory where the loaded embeddings are cached in a binary format
     """
-    def __init__(self, filepath, lowercase=False):
-        self.filepath = filepath
-        self.lowercase = lowercase
-
-    def __iter__(self):
-        if self.filepath.endswith(".gz"):
-            fin = gzip.open(self.filepath, 'rt')
+    def __init__(self, filepath, lowercase=False, sentenceset=None, cache_dir=None):
+        super().__init__(filepath, keyset=sentenceset, lowercase=lowercase, cache_dir=cache_dir)
+        self._stream = None
+        if is_stream(filepath):
+            self._stream = _LineStream(filepath)
+            line = self._stream.first_line
         else:
-            fin = open(self.filepath, 'r')
-        for line in fin:
-            line = line.rstrip(" \r\n")
-            tokens = line.split('\t')
-            sentence = tokens[0]
-            vector = tokens[1]
-            vector_tokens = vector.split(' ')
-            if self.lowercase:
-                sentence = sentence.lower()
-            coefs = np.asarray(vector_tokens, dtype='float32')
-            yield sentence, coefs
+            fin = _open(filepath)
+            line = fin.readline()
+            fin.close()
+        self.dim = line.rstrip(" \r\n").partition('\t')[2].count(' ') + 1
 
-        fin.close()
+    def _lines(self):
+        line_nb = 0
+        fin = self._stream if self._stream is not None else _open(self.filepath)
+        with tqdm.tqdm(desc="Loading '{}' progress".format(self.filepath),
+                       unit=" sentences") as pbar:
+            for line in fin:
+                line_nb += 1
+                pbar.update(1)
+                line = line.rstrip(" \r\n")
+                sentence, _, vector = line.partition('\t')
+                if self.dim != vector.count(' ') + 1:
+                    basename = os.path.basename(self.filepath)
+                    logging.warning("[%s:%d] Embedding dimension error (%d vs %d) ! Skipping...",
+                                    basename, line_nb, vector.count(' ') + 1, self.dim)
+                    continue
+                if self.lowercase:
+                    sentence = sentence.lower()
+                yield sentence, vector
 
-    def load(self):
-        """ Loads the entire embedding file into a dictionary """
-        embeddings = {}
-        for sentences, coefs in self:
-            embeddings[sentences] = coefs
-        return embeddings
+        fin.close()
 
     def load_sentences(self):
         """ Only load the sentences in the embedding file """
         sentences = set()
-        for sentence, coefs in self:
+        for sentence, vector in self._records():
             sentences.add(sentence)
         return sentences
+
+
+INDEX_VERSION = 2
+
+
+def default_index_path(filepath, lowercase=False):
+    return filepath + (".lower" if lowercase else "") + ".idx"
+
+
+def build_offset_index(filepath, index_path=None, lowercase=False):
+    """ Builds the sidecar index of a word embedding file.
+    For each word, the index stores the byte offset and the length of its line.
+    The words are stored as a Vocabulary, so that they can be found with a binary search.
+    When a word appears several times, its last line is used.
+    The index is a directory of numpy arrays that are memory-mapped when used.
+
+    Args:
+      filepath (str): Path to the word embedding file (it can't be gzipped)
+      index_path (str): Path to the index (default: next to the embedding file)
+      lowercase (bool): Whether to lowercase the words
+
+    Returns:
+      str: Path to the index
+    """
+    if filepath.endswith(".gz"):
+        raise ValueError("Can't index a gzipped file: '{}'".format(filepath))
+    if index_path is None:
+        index_path = default_index_path(filepath, lowercase=lowercase)
+
+    dim = WordEmbeddings(filepath).dim
+    lines = {}
+    offset = 0
+    with open(filepath, 'rb') as fin:
+        for line in fin:
+            n_tokens = line.rstrip(b" \r\n").count(b' ') + 1
+            if n_tokens - 1 == dim:
+                word = line[:line.index(b' ')].decode()
+                if lowercase:
+                    word = word.lower()
+                lines[word] = (offset, len(line))
+            offset += len(line)
+
+    vocab, index = Vocabulary.from_words(lines, return_index=True)
+    positions = np.array(list(lines.values()), dtype=np.int64).reshape(-1, 2)[index]
+
+    def write(dirpath):
+        vocab.save(dirpath)
+        np.save(os.path.join(dirpath, "offsets.npy"), positions[:, 0])
+        np.save(os.path.join(dirpath, "lengths.npy"), positions[:, 1])
+        with open(os.path.join(dirpath, "meta.json"), 'w') as fout:
+            json.dump({'version': INDEX_VERSION, 'signature': file_signature(filepath), 'dim': dim}, fout)
+
+    # The index is written aside and replaces the previous one once complete
+    publish_directory(index_path, write)
+    return index_path
+
+
+def _load_index(index_path, filepath):
+    """ Returns the metadata, the vocabulary and the memory-mapped offsets and lengths of an index,
+    or None if it is missing or outdated
+    """
+    def load(dirpath):
+        meta_path = os.path.join(dirpath, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as fin:
+            meta = json.load(fin)
+        if meta.get('version') != INDEX_VERSION or meta['signature'] != file_signature(filepath):
+            return None
+        offsets = np.load(os.path.join(dirpath, "offsets.npy"), mmap_mode='r')
+        lengths = np.load(os.path.join(dirpath, "lengths.npy"), mmap_mode='r')
+        return meta, Vocabulary.load(dirpath), offsets, lengths
+
+    return load_directory(index_path, load)
+
+
+class LazyWordEmbeddings(Mapping):
+    """ Read-only dictionary of word embeddings that only reads the lines of the requested words.
+
+    The lines are found with the sidecar index of the file, which is built if it is missing or older than the file.
+    Parsed vectors are kept in memory. The file stays open until `close` is called (or the end of a with block).
+
+    Args:
+      filepath (str): Path to the file with word embeddings (it can't be gzipped)
+      wordset (set or Vocabulary): Set of words to use as a filter. Only words that are in this set will be available.
+      lowercase (bool): Whether to lowercase the words
+      index_path (str): Path to the index (default: next to the embedding file)
+    """
+    def __init__(self, filepath, wordset=None, lowercase=False, index_path=None):
+        self.filepath = filepath
+        self.wordset = wordset
+        if index_path is None:
+            index_path = default_index_path(filepath, lowercase=lowercase)
+
+        index = _load_index(index_path, filepath)
+        if index is None:
+            logging.info("Building the index of '%s'...", filepath)
+            build_offset_index(filepath, index_path=index_path, lowercase=lowercase)
+            index = _load_index(index_path, filepath)
+        meta, self._vocab, self._offsets, self._lengths = index
+        if wordset is not None:
+            # Only the entries of the wordset are kept, so that the size and the iteration agree
+            if len(wordset) < len(self._vocab):
+                positions = self._vocab.positions(list(wordset))
+                keep = np.unique(positions[positions >= 0])
+            elif isinstance(wordset, Vocabulary):
+                keep = np.flatnonzero(wordset.isin(list(self._vocab)))
+            else:
+                keep = np.flatnonzero(np.fromiter((word in wordset for word in self._vocab),
+                                                  dtype=bool, count=len(self._vocab)))
+            self._vocab = self._vocab.subset(keep)
+            self._offsets = self._offsets[keep]
+            self._lengths = self._lengths[keep]
+
+        self.dim = meta['dim']
+        self._vectors = {}
+        self._fin = open(filepath, 'rb')
+
+    def _position(self, word):
+        return self._vocab.positions([word])[0]
+
+    def __contains__(self, word):
+        return word in self._vectors or self._position(word) >= 0
+
+    def __getitem__(self, word):
+        if word in self._vectors:
+            return self._vectors[word]
+        i = self._position(word)
+        if i < 0:
+            raise KeyError(word)
+        self._fin.seek(int(self._offsets[i]))
+        line = self._fin.read(int(self._lengths[i])).decode()
+        vector = np.array(line.partition(' ')[2].split(), dtype=np.float32)
+        self._vectors[word] = vector
+        return vector
+
+    def __len__(self):
+        return len(self._vocab)
+
+    def __iter__(self):
+        return iter(self._vocab)
+
+    def close(self):
+        self._fin.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,239 @@
+# coding: utf-8
+"""
+Module to share embedding matrices between processes through named shared memory segments.
+"""
+
+import os
+import sys
+import atexit
+import signal
+import secrets
+import multiprocessing
+from collections import namedtuple
+from collections.abc import Mapping
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+from .vocabulary import Vocabulary
+
+
+# Everything a worker needs to attach to a shared model. The vocabulary maps each part of the
+# Vocabulary (buffer, offsets, hashes) to its (segment name, shape, dtype). owner_pid is the process
+# that created the segments.
+SharedDescriptor = namedtuple('SharedDescriptor', ['name', 'shape', 'dtype', 'vocabulary', 'owner_pid'])
+
+# Segments created by this process, unlinked when it exits
+_owned = {}
+_owner_pid = None
+
+# SIGTERM handler replaced by _register_cleanup, called by _terminate
+_previous_sigterm = None
+
+
+def _unlink_owned():
+    if os.getpid() != _owner_pid:
+        # Forked children inherit the registry but must leave the segments to their creator
+        return
+    for segment in list(_owned.values()):
+        _unlink(segment)
+
+
+def _close(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # Arrays still point to the segment: it is unmapped when they are garbage collected
+        pass
+
+
+def _unlink(segment):
+    _owned.pop(segment.name, None)
+    _close(segment)
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _terminate(signum, frame):
+    if callable(_previous_sigterm):
+        # The handler installed before is still in charge: the segments are unlinked if it exits
+        _previous_sigterm(signum, frame)
+    else:
+        # Turns SIGTERM into a normal exit so that the atexit handlers unlink the segments
+        sys.exit(128 + signum)
+
+
+def _register_cleanup():
+    global _owner_pid, _previous_sigterm
+    if _owner_pid == os.getpid():
+        return
+    _owner_pid = os.getpid()
+    atexit.register(_unlink_owned)
+    try:
+        previous = signal.getsignal(signal.SIGTERM)
+        if previous is not _terminate and previous not in (signal.SIG_IGN, None):
+            _previous_sigterm = previous
+            signal.signal(signal.SIGTERM, _terminate)
+    except ValueError:
+        # Not in the main thread: the resource tracker still unlinks the segments at exit
+        pass
+
+
+def _create_segment(name, array, rows=None):
+    """ Creates a segment holding a copy of the array, or of the given rows of the array,
+    and returns the segment and its (name, shape, dtype).
+    The rows are gathered directly into the segment, without an intermediate copy.
+    """
+    _register_cleanup()
+    shape = array.shape if rows is None else (len(rows),) + array.shape[1:]
+    size = int(np.prod(shape, dtype=np.int64)) * array.dtype.itemsize
+    segment = shared_memory.SharedMemory(name=name, create=True, size=max(size, 1))
+    _owned[segment.name] = segment
+    view = np.ndarray(shape, dtype=array.dtype, buffer=segment.buf)
+    if rows is None:
+        view[...] = array
+    else:
+        # mode='clip' writes into out without buffering (the rows are valid indices)
+        np.take(array, rows, axis=0, out=view, mode='clip')
+    return segment, (segment.name, shape, array.dtype.str)
+
+
+def _attach_segment(name, owner_pid):
+    """ Attaches to an existing segment without handing it over to the resource tracker of this process.
+
+    Only the creator unlinks a segment: the tracker of an unrelated process would destroy it
+    as soon as that process exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: attaching registers the segment. Processes started by the creator share its tracker,
+        # where the segment must stay registered. The others hand it back.
+        segment = shared_memory.SharedMemory(name=name)
+        parent = multiprocessing.parent_process()
+        if parent is None or parent.pid != owner_pid:
+            resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+
+def _view(segment, shape, dtype):
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+
+
+class SharedEmbeddings(Mapping):
+    """ Word embeddings stored in named shared memory segments.
+
+    The creating process owns the segments and unlinks them when it exits, including on uncaught
+    exceptions and on SIGTERM (unless the SIGTERM handler installed before keeps the process running).
+    If it is killed, the resource tracker of multiprocessing unlinks them.
+    Other processes attach to the segments with the descriptor, without copying the vectors.
+    Pickling a SharedEmbeddings only pickles its descriptor, so it can be passed directly to a process pool.
+
+    The object behaves as a read-only dictionary from words to vectors. The whole matrix is
+    the matrix attribute, whose rows follow the order of the vocabulary.
+
+    Args:
+      descriptor (SharedDescriptor): Names, shapes and types of the segments
+      segments (list): Attached segments
+      owner (bool): Whether this object created the segments
+    """
+    def __init__(self, descriptor, segments, owner=False):
+        self.descriptor = descriptor
+        self.segments = segments
+        self.owner = owner
+
+        matrix_segment, buffer_segment, offsets_segment, hashes_segment = segments
+        vocab = descriptor.vocabulary
+        self.matrix = _view(matrix_segment, descriptor.shape, descriptor.dtype)
+        self.vocabulary = Vocabulary(_view(buffer_segment, *vocab['buffer'][1:]),
+                                     _view(offsets_segment, *vocab['offsets'][1:]),
+                                     _view(hashes_segment, *vocab['hashes'][1:]))
+
+    @classmethod
+    def create(cls, keys, matrix, name=None):
+        """ Copies the vectors of the keys into new shared memory segments.
+        As in a dictionary, the last vector of a duplicate key is kept.
+        """
+        if name is None:
+            name = "wemb_" + secrets.token_hex(8)
+        keys = list(keys)
+        vocab, index = Vocabulary.from_words(reversed(keys), return_index=True)
+        matrix = np.asarray(matrix)
+        rows = len(keys) - 1 - index if len(keys) > 0 else None
+
+        segments = []
+        parts = {}
+        try:
+            segment, (_, shape, dtype) = _create_segment(name, matrix, rows)
+            segments.append(segment)
+            for part, array in (('buffer', vocab.buffer), ('offsets', vocab.offsets), ('hashes', vocab.hashes)):
+                segment, parts[part] = _create_segment("{}_{}".format(name, part), np.asarray(array))
+                segments.append(segment)
+        except BaseException:
+            for segment in segments:
+                _unlink(segment)
+            raise
+
+        return cls(SharedDescriptor(name, shape, dtype, parts, os.getpid()), segments, owner=True)
+
+    @classmethod
+    def from_embeddings(cls, embeddings, name=None):
+        """ Loads a WordEmbeddings object into shared memory """
+        keys, matrix = embeddings.load_matrix()
+        return cls.create(keys, matrix, name=name)
+
+    @classmethod
+    def attach(cls, descriptor):
+        """ Attaches to the segments of a model shared by another process """
+        names = [descriptor.name] + [descriptor.vocabulary[part][0] for part in ('buffer', 'offsets', 'hashes')]
+        segments = []
+        try:
+            for name in names:
+                segments.append(_attach_segment(name, descriptor.owner_pid))
+        except BaseException:
+            for segment in segments:
+                _close(segment)
+            raise
+        return cls(descriptor, segments)
+
+    def __reduce__(self):
+        return (SharedEmbeddings.attach, (self.descriptor,))
+
+    def lookup(self, words):
+        """ Returns the matrix of the vectors of the words (zeros for missing words) and the mask of found words """
+        positions = self.vocabulary.positions(list(words))
+        found = positions >= 0
+        vectors = np.zeros((len(positions), self.matrix.shape[1]), dtype=self.matrix.dtype)
+        vectors[found] = self.matrix[positions[found]]
+        return vectors, found
+
+    def __getitem__(self, word):
+        return self.matrix[self.vocabulary.index(word)]
+
+    def __contains__(self, word):
+        return word in self.vocabulary
+
+    def __iter__(self):
+        return iter(self.vocabulary)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def close(self):
+        """ Detaches from the segments. The owner also unlinks them. """
+        # The views must be released before the segments can be closed
+        self.matrix = None
+        self.vocabulary = None
+        for segment in self.segments:
+            if self.owner:
+                _unlink(segment)
+            else:
+                _close(segment)
+        self.segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
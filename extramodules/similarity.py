@@ -0,0 +1,318 @@
+# coding: utf-8
+"""
+Module with vectorized similarity and correlation functions.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy import stats
+from .atomicdir import atomic_write
+
+
+def embedding_matrix(words, word2vec, dtype=np.float32):
+    """ Stacks the vectors of the given words into a matrix.
+
+    Args:
+      words (list): Words to look up
+      word2vec (dict): Mapping from words to vectors, or SharedEmbeddings
+      dtype: Type of the returned matrix
+
+    Returns:
+      (matrix, found): Matrix with one row per word (zeros for missing words) and the boolean mask of found words
+    """
+    if hasattr(word2vec, 'lookup'):
+        # Vectorized lookup of the shared embeddings
+        matrix, found = word2vec.lookup(words)
+        return matrix.astype(dtype, copy=False), found
+
+    found = np.fromiter((word in word2vec for word in words), dtype=bool, count=len(words))
+    if not found.any():
+        return np.zeros((len(words), 0), dtype=dtype), found
+
+    vectors = [word2vec[word] for word, is_found in zip(words, found) if is_found]
+    matrix = np.zeros((len(words), len(vectors[0])), dtype=dtype)
+    matrix[found] = vectors
+    return matrix, found
+
+
+def normalize_rows(matrix):
+    """ Returns a copy of the matrix with L2-normalized rows. Null rows are left untouched. """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def cosine_matrix(matrix):
+    """ Computes the cosine similarity between every pair of rows with a single matrix product. """
+    normalized = normalize_rows(matrix)
+    return normalized @ normalized.T
+
+
+def spearman_rows(preds, labels):
+    """ Computes the Spearman correlation between each row of preds and labels.
+
+    Args:
+      preds (np.ndarray): Matrix of shape (m, n) with one set of predictions per row
+      labels (np.ndarray): Vector of shape (n,)
+
+    Returns:
+      np.ndarray: Vector of shape (m,) with the correlation of each row
+    """
+    label_ranks = stats.rankdata(labels)
+    label_ranks -= label_ranks.mean()
+    pred_ranks = stats.rankdata(preds, axis=1)
+    pred_ranks -= pred_ranks.mean(axis=1, keepdims=True)
+
+    num = pred_ranks @ label_ranks
+    den = np.linalg.norm(pred_ranks, axis=1) * np.linalg.norm(label_ranks)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return num / den
+
+
+def paired_cosine(matrix1, matrix2):
+    """ Computes the cosine similarity between each row of matrix1 and the same row of matrix2. """
+    return np.einsum('ij,ij->i', normalize_rows(matrix1), normalize_rows(matrix2))
+
+
+SIMILARITIES = ('cosine', 'dot', 'euclidean', 'csls')
+
+
+def paired_similarity(matrix1, matrix2, similarity='cosine', knn1=None, knn2=None):
+    """ Computes the similarity between each row of matrix1 and the same row of matrix2.
+
+    Args:
+      matrix1 (np.ndarray): First vectors of the pairs
+      matrix2 (np.ndarray): Second vectors of the pairs
+      similarity (str): 'cosine', 'dot', 'euclidean' (negated distance, so that higher means more similar)
+                        or 'csls' (cross-domain similarity local scaling)
+      knn1 (np.ndarray): For CSLS, mean similarity of each first vector to its nearest neighbours
+      knn2 (np.ndarray): For CSLS, mean similarity of each second vector to its nearest neighbours
+    """
+    if similarity == 'cosine':
+        return paired_cosine(matrix1, matrix2)
+    elif similarity == 'dot':
+        return np.einsum('ij,ij->i', matrix1, matrix2)
+    elif similarity == 'euclidean':
+        return -np.linalg.norm(matrix1 - matrix2, axis=1)
+    elif similarity == 'csls':
+        return 2 * paired_cosine(matrix1, matrix2) - knn1 - knn2
+    raise ValueError("Unknown similarity: {}".format(similarity))
+
+
+def similarity_matrix(matrix, similarity='cosine', knn=None):
+    """ Computes the similarity between every pair of rows with a single matrix product.
+    See paired_similarity for the available similarities.
+    """
+    if similarity == 'cosine':
+        return cosine_matrix(matrix)
+    elif similarity == 'dot':
+        return matrix @ matrix.T
+    elif similarity == 'euclidean':
+        sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+        sq_dists = sq_norms[:, np.newaxis] + sq_norms[np.newaxis, :] - 2 * (matrix @ matrix.T)
+        return -np.sqrt(np.maximum(sq_dists, 0))
+    elif similarity == 'csls':
+        return 2 * cosine_matrix(matrix) - knn[:, np.newaxis] - knn[np.newaxis, :]
+    raise ValueError("Unknown similarity: {}".format(similarity))
+
+
+def _knn_block(queries, vocab, k, vocab_block_size):
+    """ Returns the k highest cosine similarities of each normalized query, scanning the vocabulary by blocks.
+    The rows of the vocabulary are normalized one block at a time.
+    """
+    top = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    for start in range(0, len(vocab), vocab_block_size):
+        block = normalize_rows(np.asarray(vocab[start:start + vocab_block_size], dtype=np.float32))
+        sims = queries @ block.T
+        candidates = np.concatenate((top, sims), axis=1)
+        if candidates.shape[1] > k:
+            candidates = np.partition(candidates, -k, axis=1)[:, -k:]
+        top = candidates
+    return top
+
+
+def knn_mean_similarity(queries, vocab, k=10, exclude_self=True, block_size=1024, vocab_block_size=65536, jobs=1):
+    """ Computes the mean cosine similarity of each query to its k nearest neighbours in the vocabulary.
+
+    The similarities are computed by blocks of queries and vocabulary rows, so that the memory used
+    is bounded by block_size * vocab_block_size. The vocabulary is never copied as a whole: each block
+    is normalized when it is scanned. Blocks of queries are processed by a pool of threads.
+
+    Args:
+      queries (np.ndarray): Query vectors
+      vocab (np.ndarray): Vectors of the whole vocabulary, not necessarily normalized
+      k (int): Number of neighbours
+      exclude_self (bool): Whether the queries are in the vocabulary, in which case their closest neighbour is ignored
+      block_size (int): Number of queries per block
+      vocab_block_size (int): Number of vocabulary rows per block
+      jobs (int): Number of threads
+    """
+    queries = normalize_rows(np.asarray(queries, dtype=np.float32))
+    n_neighbours = k + 1 if exclude_self else k
+
+    def process(start):
+        top = _knn_block(queries[start:start + block_size], vocab, n_neighbours, vocab_block_size)
+        if exclude_self:
+            top = np.sort(top, axis=1)[:, :-1]
+        return top.mean(axis=1)
+
+    starts = range(0, len(queries), block_size)
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            blocks = list(executor.map(process, starts))
+    else:
+        blocks = [process(start) for start in starts]
+
+    return np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+
+
+def _vocabulary_matrix(word2vec):
+    """ Returns a matrix with the vectors of every word of a dictionary.
+    The vectors of a model loaded with load() are the rows of the matrix of load_matrix(), which is used
+    in place. The vectors of other dictionaries are copied one by one into a preallocated matrix.
+    """
+    vectors = word2vec.values()
+    base = getattr(next(iter(vectors), None), 'base', None)
+    if (isinstance(base, np.ndarray) and base.ndim == 2 and len(base) == len(word2vec)
+            and all(vector.base is base and vector.shape == base.shape[1:] for vector in vectors)):
+        return base
+
+    matrix = np.empty((len(word2vec), len(next(iter(vectors)))), dtype=np.float32)
+    for i, vector in enumerate(vectors):
+        matrix[i] = vector
+    return matrix
+
+
+def knn_statistics(words, word2vec, k=10, cache_path=None, jobs=1):
+    """ Returns the mean similarity of each word to its k nearest neighbours among all the words of the model
+    (NaN for words missing from the model).
+
+    If cache_path is given, the statistics are cached in this file and only the words that aren't already
+    in the cache are computed.
+
+    The matrix of a SharedEmbeddings, or the one a dictionary was loaded from, is scanned in place.
+    """
+    cached = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            cached = dict(zip(cache['words'].tolist(), cache['knn'].tolist()))
+
+    missing = [word for word in words if word not in cached and word in word2vec]
+    if missing:
+        vocab = getattr(word2vec, 'matrix', None)
+        if vocab is None:
+            vocab = _vocabulary_matrix(word2vec)
+        queries = np.asarray([word2vec[word] for word in missing], dtype=np.float32)
+        cached.update(zip(missing, knn_mean_similarity(queries, vocab, k=k, jobs=jobs).tolist()))
+        if cache_path is not None:
+            atomic_write(cache_path, lambda fout: np.savez(fout, words=np.array(list(cached), dtype=str),
+                                                           knn=np.array(list(cached.values()))))
+
+    return np.array([cached.get(word, np.nan) for word in words], dtype=np.float64)
+
+
+def spearman_pvalue(rho, n):
+    """ Two-sided p-value of Spearman correlations computed on n elements (same as scipy.stats.spearmanr) """
+    dof = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = rho * np.sqrt((dof / ((rho + 1.0) * (1.0 - rho))).clip(0))
+    return 2 * stats.t.sf(np.abs(t), dof)
+
+
+def batch_spearman(preds, labels):
+    """ Computes the Spearman correlation between each row of preds and labels, ignoring the NaNs.
+
+    The rows that have the same missing values are processed together: the labels are ranked once
+    for each group and the correlations of the group are computed with one matrix product.
+
+    Args:
+      preds (np.ndarray): Matrix of shape (m, n) with one set of predictions per row (NaN when missing)
+      labels (np.ndarray): Vector of shape (n,) (NaN when missing)
+
+    Returns:
+      (rho, p, found): Vectors of shape (m,) with the correlations, their p-values and the number of pairs used
+    """
+    valid = ~np.isnan(preds) & ~np.isnan(labels)
+    rho = np.full(len(preds), np.nan)
+    p = np.full(len(preds), np.nan)
+
+    patterns, inverse = np.unique(valid, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for group, mask in enumerate(patterns):
+        rows = np.flatnonzero(inverse == group)
+        n = int(mask.sum())
+        if n < 2:
+            continue
+        rho[rows] = spearman_rows(preds[np.ix_(rows, mask)], labels[mask])
+        p[rows] = spearman_pvalue(rho[rows], n)
+
+    return rho, p, valid.sum(axis=1)
+
+
+def batch_kendall(preds, labels, jobs=1):
+    """ Computes the Kendall tau between each row of preds and labels, ignoring the NaNs.
+    The rows are processed by a pool of threads.
+
+    Returns:
+      (tau, p): Vectors of shape (m,) with the correlations and their p-values
+    """
+    def kendall(pred):
+        mask = ~np.isnan(pred) & ~np.isnan(labels)
+        return stats.kendalltau(labels[mask], pred[mask])
+
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(kendall, preds))
+    else:
+        results = [kendall(pred) for pred in preds]
+
+    tau = np.array([result[0] for result in results], dtype=np.float64).reshape(-1)
+    p = np.array([result[1] for result in results], dtype=np.float64).reshape(-1)
+    return tau, p
+
+
+def randomized_svd(matrix, rank, n_oversamples=10, n_iter=4, rng=None):
+    """ Computes an approximation of the rank first singular triplets of a matrix
+    (randomized range finder with power iterations, Halko et al. 2011).
+
+    Returns:
+      (U, s, Vt): Left singular vectors (n, rank), singular values (rank,) and right singular vectors (rank, dim)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    n_components = min(rank + n_oversamples, *matrix.shape)
+    basis = matrix @ rng.standard_normal((matrix.shape[1], n_components)).astype(matrix.dtype)
+    for _ in range(n_iter):
+        # The basis is orthonormalized at each step to keep the small singular directions accurate
+        basis, _ = np.linalg.qr(basis)
+        basis, _ = np.linalg.qr(matrix.T @ basis)
+        basis = matrix @ basis
+    basis, _ = np.linalg.qr(basis)
+
+    u, s, vt = np.linalg.svd(basis.T @ matrix, full_matrices=False)
+    return (basis @ u)[:, :rank], s[:rank], vt[:rank]
+
+
+def prefix_similarities(matrix1, matrix2, dims, similarity='cosine'):
+    """ Computes the similarity between each row of matrix1 and the same row of matrix2, keeping only the
+    first d columns, for every d in dims. All the dimensions are computed in one pass with cumulative sums.
+
+    Returns:
+      np.ndarray: Matrix of shape (len(dims), n) with the similarities of each dimension
+    """
+    columns = np.asarray(dims) - 1
+    if similarity == 'euclidean':
+        return -np.sqrt(np.cumsum((matrix1 - matrix2) ** 2, axis=1)[:, columns].T)
+
+    dots = np.cumsum(matrix1 * matrix2, axis=1)[:, columns].T
+    if similarity == 'dot':
+        return dots
+    elif similarity == 'cosine':
+        norms1 = np.sqrt(np.cumsum(matrix1 * matrix1, axis=1)[:, columns].T)
+        norms2 = np.sqrt(np.cumsum(matrix2 * matrix2, axis=1)[:, columns].T)
+        norms = norms1 * norms2
+        # Same convention as normalize_rows: null vectors have a null similarity
+        norms[norms == 0] = 1
+        return dots / norms
+    raise ValueError("Similarity not supported by prefix_similarities: {}".format(similarity))
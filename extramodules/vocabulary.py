@@ -0,0 +1,298 @@
+# coding: utf-8
+"""
+Module with a compact vocabulary structure for large sets of words.
+"""
+
+import os
+import numpy as np
+
+
+_BASE = np.uint64(0x100000001b3)
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+
+# Number of words encoded and hashed at once when building a vocabulary
+_CHUNK_SIZE = 1 << 18
+# Number of words whose bytes are gathered at once, which bounds the temporary arrays of byte positions
+_BLOCK_SIZE = 1 << 16
+
+
+def _hash(buffer, offsets):
+    """ Computes a 64-bit hash of each byte string of the buffer, delimited by offsets """
+    lengths = np.diff(offsets)
+    hashes = np.zeros(len(lengths), dtype=np.uint64)
+    if len(buffer) > 0:
+        # Polynomial hash computed with Horner's rule, one byte position at a time: the words are sorted
+        # by decreasing length so that the words that still have a byte at a position form a prefix
+        order = np.argsort(-lengths, kind='stable')
+        starts = offsets[:-1][order]
+        remaining = np.searchsorted(lengths[order][::-1], np.arange(lengths.max()), side='right')
+        sorted_hashes = np.zeros(len(lengths), dtype=np.uint64)
+        for position, n_shorter in enumerate(remaining):
+            n = len(lengths) - n_shorter
+            sorted_hashes[:n] = sorted_hashes[:n] * _BASE + buffer[starts[:n] + position]
+        # Sum of byte * BASE^(position from the end of the word + 1)
+        hashes[order] = sorted_hashes * _BASE
+
+    # Finalizer of splitmix64, so that close words get distant hashes
+    hashes ^= lengths.astype(np.uint64) * _MIX2
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= _MIX1
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= _MIX2
+    hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+def _encode(words):
+    """ Encodes the words into a single UTF-8 buffer and their offsets """
+    encoded = [word.encode() for word in words]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def _chunks(words, size):
+    chunk = []
+    for word in words:
+        chunk.append(word)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _gather(buffer, offsets, indices):
+    """ Returns the buffer and offsets of the byte strings at indices """
+    indices = np.asarray(indices, dtype=np.int64)
+    starts = offsets[indices]
+    lengths = offsets[indices + 1] - starts
+    new_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    new_buffer = np.empty(new_offsets[-1], dtype=np.uint8)
+    for start in range(0, len(indices), _BLOCK_SIZE):
+        end = min(start + _BLOCK_SIZE, len(indices))
+        first, last = new_offsets[start], new_offsets[end]
+        shifts = starts[start:end] - (new_offsets[start:end] - first)
+        positions = np.repeat(shifts, lengths[start:end]) + np.arange(last - first)
+        new_buffer[first:last] = buffer[positions]
+    return new_buffer, new_offsets
+
+
+def _bytes(buffer, offsets, i):
+    return buffer[offsets[i]:offsets[i + 1]].tobytes()
+
+
+def _equal(buffer1, offsets1, indices1, buffer2, offsets2, indices2):
+    """ Compares the byte strings at indices1 in the first buffer with the ones at indices2 in the second buffer """
+    indices1 = np.asarray(indices1, dtype=np.int64)
+    indices2 = np.asarray(indices2, dtype=np.int64)
+    equal = (offsets1[indices1 + 1] - offsets1[indices1]) == (offsets2[indices2 + 1] - offsets2[indices2])
+    same_length = np.flatnonzero(equal)
+    for start in range(0, len(same_length), _BLOCK_SIZE):
+        block = same_length[start:start + _BLOCK_SIZE]
+        gathered1, gathered_offsets = _gather(buffer1, offsets1, indices1[block])
+        gathered2, _ = _gather(buffer2, offsets2, indices2[block])
+        mismatches = np.flatnonzero(gathered1 != gathered2)
+        if len(mismatches) > 0:
+            words = np.searchsorted(gathered_offsets, mismatches, side='right') - 1
+            equal[block[words]] = False
+    return equal
+
+
+def _distinct(buffer, offsets, hashes):
+    """ Returns the index of the first occurrence of each distinct word, sorted by hash.
+    Distinct words with the same hash are all kept.
+    """
+    unique, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    same = _equal(buffer, offsets, np.arange(len(inverse)), buffer, offsets, first[inverse])
+    if same.all():
+        return first
+
+    # Hash collisions: the other words of a hash are compared as bytes
+    colliding = {}
+    for i in np.flatnonzero(~same):
+        colliding.setdefault(_bytes(buffer, offsets, i), i)
+    keep = np.concatenate((first, np.array(sorted(colliding.values()), dtype=np.int64)))
+    return keep[np.argsort(hashes[keep], kind='stable')]
+
+
+class Vocabulary:
+    """ Set of words stored in a single UTF-8 buffer.
+
+    The words are sorted by their 64-bit hash: membership is a binary search on the hashes, and
+    intersections and unions are computed with numpy on the hash arrays.
+    Distinct words with the same hash are stored next to each other and told apart by their bytes.
+
+    Args:
+      buffer (np.ndarray): UTF-8 bytes of the words (uint8)
+      offsets (np.ndarray): Offsets of the words in the buffer (n_words + 1)
+      hashes (np.ndarray): Sorted hashes of the words
+    """
+    def __init__(self, buffer, offsets, hashes):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.hashes = hashes
+
+    @classmethod
+    def from_words(cls, words, return_index=False):
+        """ Builds the vocabulary of an iterable of words. Duplicate words are removed.
+
+        The words are encoded, hashed and deduplicated by chunks, and the vocabularies of the chunks are merged,
+        so that the memory used is about the size of the vocabulary rather than of the words.
+
+        If return_index is True, also returns for each entry of the vocabulary the index
+        of its first occurrence in words.
+        """
+        # Vocabularies of the chunks, with the index of their words, merged when they have similar sizes
+        parts = []
+        n_words = 0
+        for chunk in _chunks(words, _CHUNK_SIZE):
+            buffer, offsets = _encode(chunk)
+            hashes = _hash(buffer, offsets)
+            first = _distinct(buffer, offsets, hashes)
+            buffer, offsets = _gather(buffer, offsets, first)
+            parts.append((cls(buffer, offsets, hashes[first]), first + n_words))
+            n_words += len(chunk)
+            while len(parts) > 1 and len(parts[-2][0]) <= 2 * len(parts[-1][0]):
+                parts.append(cls._merge_parts(parts.pop(-2), parts.pop()))
+        while len(parts) > 1:
+            parts.append(cls._merge_parts(parts.pop(-2), parts.pop()))
+
+        if parts:
+            vocab, index = parts[0]
+        else:
+            vocab = cls(np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.uint64))
+            index = np.zeros(0, dtype=np.int64)
+        if return_index:
+            return vocab, index
+        return vocab
+
+    @staticmethod
+    def _merge_parts(part1, part2):
+        """ Merges the vocabularies of two consecutive chunks of words, keeping the first occurrences """
+        (vocab1, index1), (vocab2, index2) = part1, part2
+        new = np.flatnonzero(vocab1._find(vocab2.buffer, vocab2.offsets, vocab2.hashes) < 0)
+        merged, order = vocab1._merge(vocab2.subset(new))
+        return merged, np.concatenate((index1, index2[new]))[order]
+
+    def _merge(self, other):
+        """ Merges the entries of another vocabulary, which must not contain words of this one.
+        Returns the merged vocabulary and the position of each of its entries in the concatenation of both.
+        """
+        positions1 = np.arange(len(self)) + np.searchsorted(other.hashes, self.hashes, side='left')
+        positions2 = np.arange(len(other)) + np.searchsorted(self.hashes, other.hashes, side='right')
+        order = np.empty(len(self) + len(other), dtype=np.int64)
+        order[positions1] = np.arange(len(self))
+        order[positions2] = len(self) + np.arange(len(other))
+        hashes = np.empty(len(order), dtype=np.uint64)
+        hashes[positions1] = self.hashes
+        hashes[positions2] = other.hashes
+
+        buffer = np.concatenate((self.buffer, other.buffer))
+        offsets = np.concatenate((self.offsets[:-1], other.offsets + self.offsets[-1]))
+        buffer, offsets = _gather(buffer, offsets, order)
+        return Vocabulary(buffer, offsets, hashes), order
+
+    @classmethod
+    def from_file(cls, filename):
+        """ Builds the vocabulary of a file with one word per line. Empty lines are ignored. """
+        with open(filename, "r") as fin:
+            return cls.from_words(line.rstrip("\r\n") for line in fin if line.rstrip("\r\n"))
+
+    @classmethod
+    def load(cls, dirpath, mmap=True):
+        """ Loads a vocabulary saved with `save`. The arrays are memory-mapped by default. """
+        mmap_mode = 'r' if mmap else None
+        return cls(np.load(os.path.join(dirpath, "words.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(dirpath, "word_offsets.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(dirpath, "hashes.npy"), mmap_mode=mmap_mode))
+
+    @staticmethod
+    def is_saved(dirpath):
+        return os.path.exists(os.path.join(dirpath, "hashes.npy"))
+
+    def save(self, dirpath):
+        """ Saves the vocabulary into a directory of numpy arrays """
+        os.makedirs(dirpath, exist_ok=True)
+        np.save(os.path.join(dirpath, "words.npy"), self.buffer)
+        np.save(os.path.join(dirpath, "word_offsets.npy"), self.offsets)
+        np.save(os.path.join(dirpath, "hashes.npy"), self.hashes)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __getitem__(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _find(self, buffer, offsets, hashes):
+        """ Returns the position of each encoded word in the vocabulary (-1 for unknown words) """
+        first = np.searchsorted(self.hashes, hashes, side='left')
+        end = np.searchsorted(self.hashes, hashes, side='right')
+        candidates = np.flatnonzero(end > first)
+        found = np.zeros(len(hashes), dtype=bool)
+        found[candidates] = _equal(buffer, offsets, candidates, self.buffer, self.offsets, first[candidates])
+
+        # Hash collisions: the other entries with the same hash are compared one by one
+        for i in np.flatnonzero(~found & (end - first > 1)):
+            word = _bytes(buffer, offsets, i)
+            for position in range(first[i] + 1, end[i]):
+                if _bytes(self.buffer, self.offsets, position) == word:
+                    first[i] = position
+                    found[i] = True
+                    break
+
+        first[~found] = -1
+        return first
+
+    def positions(self, words):
+        """ Returns the position of each word in the vocabulary (-1 for unknown words) """
+        buffer, offsets = _encode(words)
+        return self._find(buffer, offsets, _hash(buffer, offsets))
+
+    def isin(self, words):
+        """ Returns a boolean mask telling which words are in the vocabulary """
+        return self.positions(words) >= 0
+
+    def index(self, word):
+        """ Returns the position of a word in the vocabulary """
+        position = self.positions([word])[0]
+        if position < 0:
+            raise KeyError(word)
+        return position
+
+    def __contains__(self, word):
+        return self.positions([word])[0] >= 0
+
+    def subset(self, indices):
+        """ Returns the vocabulary of the words at the given sorted positions """
+        buffer, offsets = _gather(self.buffer, self.offsets, indices)
+        return Vocabulary(buffer, offsets, self.hashes[indices])
+
+    def intersection(self, *others):
+        """ Returns the words that are in this vocabulary and in all the others """
+        result = self
+        for other in others:
+            found = other._find(result.buffer, result.offsets, result.hashes) >= 0
+            result = result.subset(np.flatnonzero(found))
+        return result
+
+    def union(self, *others):
+        """ Returns the words that are in this vocabulary or in any of the others """
+        result = self
+        for other in others:
+            new = np.flatnonzero(result._find(other.buffer, other.offsets, other.hashes) < 0)
+            result, _ = result._merge(other.subset(new))
+        return result
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __or__(self, other):
+        return self.union(other)
@@ -0,0 +1,265 @@
+# coding: utf-8
+"""
+Module with a work queue stored in a directory of a shared filesystem.
+
+Tasks are claimed through lock files created atomically, so that any number of workers,
+on one or several hosts, can process the same queue.
+"""
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from .atomicdir import atomic_write
+
+
+def _write_json(filepath, content):
+    """ Writes a JSON file atomically: readers see either nothing or the whole file """
+    atomic_write(filepath, lambda fout: json.dump(content, fout, indent=1, sort_keys=True), mode='w')
+
+
+def _read_json(filepath):
+    with open(filepath, 'r') as fin:
+        return json.load(fin)
+
+
+def _create_claim(filepath, owner):
+    """ Creates a lock file that doesn't exist yet. Returns False if it already exists. """
+    try:
+        fd = os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as fout:
+        json.dump(owner, fout)
+    return True
+
+
+class Claim:
+    """ Lock file of a task held by this worker. A thread refreshes its modification time
+    until it is released, so that other workers can tell live claims from stale ones.
+
+    A worker that checks whether the claim is stale moves it away for a moment. If the lock file is
+    missing when it is refreshed, it is created again, unless another worker has claimed the task since.
+    """
+    def __init__(self, filepath, owner, heartbeat):
+        self.filepath = filepath
+        self.owner = owner
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._beat, args=(heartbeat,), daemon=True)
+        self.thread.start()
+
+    def _is_owned(self):
+        try:
+            return _read_json(self.filepath) == self.owner
+        except ValueError:
+            # Lock file of another worker being written
+            return False
+
+    def _refresh(self):
+        """ Refreshes the lock file. Returns False if the task was claimed by another worker. """
+        try:
+            if self._is_owned():
+                os.utime(self.filepath)
+                return True
+        except FileNotFoundError:
+            if _create_claim(self.filepath, self.owner):
+                logging.warning("Claim '%s' was removed by another worker, it was created again", self.filepath)
+                return True
+        return self._is_owned()
+
+    def _beat(self, heartbeat):
+        while not self.stopped.wait(heartbeat):
+            try:
+                owned = self._refresh()
+            except FileNotFoundError:
+                # Removed again between two attempts: the next beat creates it
+                continue
+            if not owned:
+                logging.warning("Claim '%s' was taken over by another worker", self.filepath)
+                return
+
+    def release(self):
+        self.stopped.set()
+        self.thread.join()
+        try:
+            if self._is_owned():
+                os.unlink(self.filepath)
+        except FileNotFoundError:
+            pass
+
+
+class WorkQueue:
+    """ Queue of tasks in a directory:
+
+      tasks/<id>.json     description of each task
+      claims/<id>.lock    claim of a task by a worker (host, pid and time)
+      results/<id>.json   result of each finished task
+      results/<id>.*      additional files of the results
+
+    A claim whose lock file was not refreshed for stale_timeout seconds belongs to a dead worker:
+    it is removed and the task is claimed again. The age of a lock file is measured with the clock
+    of the filesystem, so that the clocks of the hosts don't need to agree.
+
+    Args:
+      directory (str): Directory of the queue
+      stale_timeout (float): Seconds after which a claim that is not refreshed is stale
+    """
+    def __init__(self, directory, stale_timeout=600):
+        self.directory = directory
+        self.stale_timeout = stale_timeout
+        self.tasks_dir = os.path.join(directory, "tasks")
+        self.claims_dir = os.path.join(directory, "claims")
+        self.results_dir = os.path.join(directory, "results")
+
+    def create(self, tasks):
+        """ Writes the tasks of a new queue. Returns the ids of the tasks. """
+        if os.path.isdir(self.tasks_dir) and os.listdir(self.tasks_dir):
+            raise ValueError("The queue '{}' already has tasks".format(self.directory))
+        for dirpath in (self.tasks_dir, self.claims_dir, self.results_dir):
+            os.makedirs(dirpath, exist_ok=True)
+
+        width = len(str(len(tasks)))
+        task_ids = []
+        for i, task in enumerate(tasks):
+            task_id = str(i).zfill(width)
+            _write_json(os.path.join(self.tasks_dir, task_id + ".json"), task)
+            task_ids.append(task_id)
+        return task_ids
+
+    def task_ids(self):
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(self.tasks_dir) if name.endswith(".json"))
+
+    def task(self, task_id):
+        return _read_json(os.path.join(self.tasks_dir, task_id + ".json"))
+
+    def _claim_path(self, task_id):
+        return os.path.join(self.claims_dir, task_id + ".lock")
+
+    def result_path(self, task_id, suffix=".json"):
+        return os.path.join(self.results_dir, task_id + suffix)
+
+    def is_done(self, task_id):
+        return os.path.exists(self.result_path(task_id))
+
+    def _now(self):
+        """ Current time of the filesystem of the queue: modification time of a file created just now """
+        probe_path = os.path.join(self.claims_dir, ".probe.{}.{}".format(socket.gethostname(), os.getpid()))
+        with open(probe_path, 'w'):
+            pass
+        try:
+            return os.stat(probe_path).st_mtime
+        finally:
+            os.unlink(probe_path)
+
+    def is_stale(self, filepath, now=None):
+        try:
+            mtime = os.stat(filepath).st_mtime
+        except FileNotFoundError:
+            return False
+        if now is None:
+            now = self._now()
+        return now - mtime > self.stale_timeout
+
+    def _requeue(self, task_id):
+        """ Removes a stale claim. Returns True if this worker removed it. """
+        claim_path = self._claim_path(task_id)
+        moved_path = "{}.stale.{}.{}".format(claim_path, socket.gethostname(), os.getpid())
+        # Renaming is atomic: only one of the workers that found the claim stale removes it
+        try:
+            os.rename(claim_path, moved_path)
+        except FileNotFoundError:
+            return False
+        if not self.is_stale(moved_path):
+            # The claim was renewed between the check and the rename: it is put back
+            try:
+                os.link(moved_path, claim_path)
+            except FileExistsError:
+                pass
+            os.unlink(moved_path)
+            return False
+        os.unlink(moved_path)
+        logging.warning("Requeued task %s: its claim was stale", task_id)
+        return True
+
+    def claim(self, task_id, heartbeat=None):
+        """ Claims a task. Returns a Claim, or None if the task is finished or claimed by a live worker. """
+        if self.is_done(task_id):
+            return None
+        claim_path = self._claim_path(task_id)
+        if self.is_stale(claim_path):
+            self._requeue(task_id)
+        owner = {'host': socket.gethostname(), 'pid': os.getpid(), 'time': time.time()}
+        if not _create_claim(claim_path, owner):
+            return None
+
+        # The task may have been finished between the check and the claim
+        if self.is_done(task_id):
+            os.unlink(claim_path)
+            return None
+        if heartbeat is None:
+            heartbeat = self.stale_timeout / 4
+        return Claim(claim_path, owner, heartbeat)
+
+    def complete(self, task_id, result):
+        """ Records the result of a task. Additional result files must be written before. """
+        _write_json(self.result_path(task_id), result)
+
+    def result(self, task_id):
+        return _read_json(self.result_path(task_id))
+
+    def status(self):
+        """ Returns the ids of the (done, running, stale, pending) tasks """
+        done, running, stale, pending = [], [], [], []
+        now = self._now()
+        for task_id in self.task_ids():
+            if self.is_done(task_id):
+                done.append(task_id)
+            elif os.path.exists(self._claim_path(task_id)):
+                (stale if self.is_stale(self._claim_path(task_id), now) else running).append(task_id)
+            else:
+                pending.append(task_id)
+        return done, running, stale, pending
+
+    def run(self, process, wait=False, poll_interval=30):
+        """ Processes tasks until none is left.
+
+        Args:
+          process (callable): Called with the queue, the id and the description of each claimed task.
+                              It writes its result files and returns the JSON result of the task.
+          wait (bool): Whether to wait for the tasks claimed by other workers, to take them over if they become stale
+          poll_interval (float): Seconds between two scans of the queue while waiting
+
+        Returns:
+          (processed, failed): Ids of the tasks processed and of the tasks that failed in this worker
+        """
+        processed, failed = [], []
+        while True:
+            remaining = [task_id for task_id in self.task_ids()
+                         if task_id not in failed and not self.is_done(task_id)]
+            if not remaining:
+                break
+
+            claimed = False
+            for task_id in remaining:
+                claim = self.claim(task_id)
+                if claim is None:
+                    continue
+                claimed = True
+                try:
+                    logging.info("Processing task %s...", task_id)
+                    self.complete(task_id, process(self, task_id, self.task(task_id)))
+                    processed.append(task_id)
+                except Exception:
+                    logging.exception("Task %s failed", task_id)
+                    failed.append(task_id)
+                finally:
+                    claim.release()
+
+            if not claimed:
+                if not wait:
+                    break
+                time.sleep(poll_interval)
+
+        return processed, failed
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# coding: utf8
+"""
+Distributes the evaluation of a grid of models x datasets x splits x similarities over several workers.
+
+  grid.py expand grid.json queue/     writes one task per (dataset, model, similarity) in the queue
+  grid.py work queue/                 processes tasks until none is left (run as many workers as needed)
+  grid.py status queue/               counts the finished, running, stale and pending tasks
+  grid.py reduce queue/ results/      writes the wordsim CSV and the corrmatrix matrix of each dataset and similarity
+
+The queue directory must be on a filesystem shared by the workers, which run from the same working directory.
+The grid is a JSON file:
+
+  {
+    "datasets": ["data/ldt/ldt_200ms.csv"],
+    "splits": ["dev_p1", "test_p1"],
+    "embeddings": ["embeddings/", "other/*.txt"],
+    "similarities": ["cosine", "csls"],
+    "csls_k": 10,
+    "outputs": ["wordsim", "corrmatrix"],
+    "wordset": null,
+    "cache_dir": null
+  }
+
+Only "datasets" and "embeddings" are required. Without splits, the datasets are used as they are.
+"""
+
+import os
+import json
+import logging
+import argparse
+import numpy as np
+import wordsim
+import corrmatrix
+from extramodules.embeddings import WordEmbeddings
+from extramodules.similarity import knn_statistics, SIMILARITIES
+from extramodules.workqueue import WorkQueue
+from extramodules.atomicdir import atomic_write
+
+
+OUTPUTS = ('wordsim', 'corrmatrix')
+
+
+def argparser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--logger', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    expand_parser = subparsers.add_parser('expand', help="Writes the tasks of a grid in a new queue")
+    expand_parser.add_argument('grid', help="Path to the JSON description of the grid")
+    expand_parser.add_argument('queue', help="Directory of the queue")
+
+    work_parser = subparsers.add_parser('work', help="Processes the tasks of a queue")
+    work_parser.add_argument('queue', help="Directory of the queue")
+    work_parser.add_argument('--wait', action='store_true',
+                             help="Wait for the tasks claimed by other workers, to take them over if they become stale")
+    work_parser.add_argument('--poll_interval', type=float, default=30,
+                             help="Seconds between two scans of the queue while waiting (default: 30)")
+    work_parser.add_argument('--stale_timeout', type=float, default=600,
+                             help="Seconds after which the claim of a worker that stopped is stale (default: 600)")
+    work_parser.add_argument('-j', '--jobs', type=int, default=1,
+                             help="Number of threads used to compute the nearest neighbours of CSLS")
+
+    status_parser = subparsers.add_parser('status', help="Counts the tasks of a queue by state")
+    status_parser.add_argument('queue', help="Directory of the queue")
+    status_parser.add_argument('--stale_timeout', type=float, default=600,
+                               help="Seconds after which the claim of a worker that stopped is stale (default: 600)")
+
+    reduce_parser = subparsers.add_parser('reduce', help="Merges the results of a queue")
+    reduce_parser.add_argument('queue', help="Directory of the queue")
+    reduce_parser.add_argument('output', help="Directory of the result files")
+    reduce_parser.add_argument('--partial', action='store_true',
+                               help="Write the results even if some tasks are not finished")
+
+    args = parser.parse_args()
+
+    numeric_level = getattr(logging, args.logger.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError("Invalid log level: {}".format(args.logger))
+    logging.basicConfig(level=numeric_level, format="%(asctime)s %(levelname)s %(message)s")
+
+    return args
+
+
+def load_grid(filepath):
+    with open(filepath, 'r') as fin:
+        grid = json.load(fin)
+
+    for key in ('datasets', 'embeddings'):
+        if not grid.get(key):
+            raise ValueError("The grid has no {}".format(key))
+    grid.setdefault('splits', [])
+    grid.setdefault('similarities', ['cosine'])
+    grid.setdefault('csls_k', 10)
+    grid.setdefault('outputs', list(OUTPUTS))
+    grid.setdefault('wordset', None)
+    grid.setdefault('cache_dir', None)
+
+    for similarity in grid['similarities']:
+        if similarity not in SIMILARITIES:
+            raise ValueError("Unknown similarity: {}".format(similarity))
+    for output in grid['outputs']:
+        if output not in OUTPUTS:
+            raise ValueError("Unknown output: {}".format(output))
+
+    return grid
+
+
+def grid_datasets(grid):
+    """ Returns the dataset files of the grid, one per split if splits are given """
+    if not grid['splits']:
+        return list(grid['datasets'])
+    return ["{}.{}.csv".format(os.path.splitext(dataset)[0], split)
+            for dataset in grid['datasets'] for split in grid['splits']]
+
+
+def expand_grid(grid):
+    """ Returns the tasks of a grid, with the list of embedding files in the order of the results """
+    embeddings = wordsim.expand_embeddings(grid['embeddings'])
+    tasks = []
+    for dataset in grid_datasets(grid):
+        for similarity in grid['similarities']:
+            for filepath in embeddings:
+                tasks.append({
+                    'dataset': dataset,
+                    'embeddings': filepath,
+                    'similarity': similarity,
+                    'csls_k': grid['csls_k'],
+                    'outputs': grid['outputs'],
+                    'wordset': grid['wordset'],
+                    'cache_dir': grid['cache_dir'],
+                })
+    return tasks, embeddings
+
+
+def save_array(filepath, array):
+    atomic_write(filepath, lambda fout: np.save(fout, array))
+
+
+class _AnyCaseEmbeddings(WordEmbeddings):
+    """ Keeps the words of the file that are in the wordset as they are or once lowercased """
+    def _filter_chunk(self, chunk):
+        keys = [key for key, vector in chunk]
+        mask = self.keyset.isin(keys) | self.keyset.isin([key.lower() for key in keys])
+        return [record for record, keep in zip(chunk, mask) if keep]
+
+
+def load_models(filepath, outputs, wordset=None, cache_dir=None):
+    """ Loads the model of each output the same way as its script: wordsim keeps the words of the file
+    as they are, corrmatrix lowercases them. When both outputs are requested, the file is read once
+    and the two dictionaries share the vectors.
+    """
+    if 'corrmatrix' not in outputs:
+        return {'wordsim': WordEmbeddings(filepath, wordset=wordset, cache_dir=cache_dir).load()}
+    if 'wordsim' not in outputs:
+        return {'corrmatrix': WordEmbeddings(filepath, wordset=wordset, lowercase=True, cache_dir=cache_dir).load()}
+
+    embeddings = WordEmbeddings if wordset is None else _AnyCaseEmbeddings
+    keys, matrix = embeddings(filepath, wordset=wordset, cache_dir=cache_dir).load_matrix()
+    lower_keys = [key.lower() for key in keys]
+    if wordset is None:
+        cased = lowercased = np.ones(len(keys), dtype=bool)
+    else:
+        cased, lowercased = wordset.isin(keys), wordset.isin(lower_keys)
+    # As in WordEmbeddings.load, the last vector of a duplicate word is kept
+    return {'wordsim': {keys[i]: matrix[i] for i in np.flatnonzero(cased)},
+            'corrmatrix': {lower_keys[i]: matrix[i] for i in np.flatnonzero(lowercased)}}
+
+
+def process_task(queue, task_id, task, jobs=1):
+    """ Evaluates one model on one dataset with one similarity.
+    Each output loads the dataset the same way as its script.
+    """
+    filepath = task['embeddings']
+    similarity = task['similarity']
+    wordset = None
+    if task['wordset'] is not None:
+        wordset = wordsim.load_wordset(task['wordset'])
+    models = load_models(filepath, task['outputs'], wordset=wordset, cache_dir=task['cache_dir'])
+    result = {}
+
+    if 'wordsim' in task['outputs']:
+        dataset, header = wordsim.load_dataset(task['dataset'])
+        word2vec = models.pop('wordsim')
+        knn = None
+        if similarity == 'csls':
+            words = wordsim.index_pairs(dataset)[0]
+            knn = dict(zip(words, knn_statistics(words, word2vec, k=task['csls_k'], jobs=jobs)))
+        name = wordsim.model_name(filepath)
+        results, _ = wordsim.evaluate_batch(dataset, {name: word2vec}, similarity, {name: knn})
+        rho, pr, tau, pt, found, notfound = results[name]
+        result['wordsim'] = [float(rho), float(pr), float(tau), float(pt), int(found), int(notfound)]
+
+    if 'corrmatrix' in task['outputs']:
+        dataset, header = corrmatrix.load_dataset(task['dataset'])
+        word2vec = models.pop('corrmatrix')
+        pred = corrmatrix.model_predictions(dataset, word2vec, similarity, task['csls_k'], jobs)
+        save_array(queue.result_path(task_id, ".corrmatrix.npy"), pred)
+
+    return result
+
+
+def prediction_correlations(preds):
+    """ Spearman correlation between the predictions of every pair of models (same as corrmatrix.py) """
+    corr_matrix = np.zeros((len(preds), len(preds)))
+    for i, pred1 in enumerate(preds):
+        for j, pred2 in enumerate(preds):
+            corr_matrix[i, j] = corrmatrix.prediction_correlation(pred1, pred2)[0]
+    return corr_matrix
+
+
+def reduce_queue(queue, output_dir, partial=False):
+    with open(os.path.join(queue.directory, "grid.json"), 'r') as fin:
+        grid = json.load(fin)
+    embeddings = grid['expanded_embeddings']
+
+    task_ids = {}
+    for task_id in queue.task_ids():
+        task = queue.task(task_id)
+        task_ids[task['dataset'], task['similarity'], task['embeddings']] = task_id
+
+    missing = [task_id for task_id in task_ids.values() if not queue.is_done(task_id)]
+    if missing and not partial:
+        raise ValueError("{} tasks are not finished: {}".format(len(missing), " ".join(missing)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    for dataset in grid_datasets(grid):
+        basename = os.path.splitext(os.path.basename(dataset))[0]
+        for similarity in grid['similarities']:
+            finished = [(filepath, task_ids[dataset, similarity, filepath]) for filepath in embeddings
+                        if queue.is_done(task_ids[dataset, similarity, filepath])]
+            if not finished:
+                continue
+            output_base = os.path.join(output_dir, "{}.{}".format(basename, similarity))
+
+            if 'wordsim' in grid['outputs']:
+                results = {wordsim.model_name(filepath): queue.result(task_id)['wordsim']
+                           for filepath, task_id in finished}
+                wordsim.dump_results(output_base + ".wordsim.csv", results)
+
+            if 'corrmatrix' in grid['outputs']:
+                preds = [np.load(queue.result_path(task_id, ".corrmatrix.npy")) for filepath, task_id in finished]
+                corrmatrix.dump_matrix(output_base + ".corrmatrix.csv", prediction_correlations(preds),
+                                       [filepath for filepath, task_id in finished])
+            logging.info("Wrote the results of %s with %s", dataset, similarity)
+
+
+def main():
+    args = argparser()
+
+    if args.command == 'expand':
+        grid = load_grid(args.grid)
+        tasks, embeddings = expand_grid(grid)
+        queue = WorkQueue(args.queue)
+        queue.create(tasks)
+        # The reducer writes the models in the order of the grid
+        grid['expanded_embeddings'] = embeddings
+        with open(os.path.join(args.queue, "grid.json"), 'w') as fout:
+            json.dump(grid, fout, indent=1)
+        logging.info("Wrote %d tasks in '%s'", len(tasks), args.queue)
+
+    elif args.command == 'work':
+        queue = WorkQueue(args.queue, stale_timeout=args.stale_timeout)
+        processed, failed = queue.run(lambda queue, task_id, task: process_task(queue, task_id, task, args.jobs),
+                                      wait=args.wait, poll_interval=args.poll_interval)
+        logging.info("Processed %d tasks, %d failed", len(processed), len(failed))
+
+    elif args.command == 'status':
+        queue = WorkQueue(args.queue, stale_timeout=args.stale_timeout)
+        done, running, stale, pending = queue.status()
+        print("done: {}, running: {}, stale: {}, pending: {}".format(len(done), len(running), len(stale), len(pending)))
+
+    elif args.command == 'reduce':
+        reduce_queue(WorkQueue(args.queue), args.output, partial=args.partial)
+
+
+if __name__ == '__main__':
+    main()
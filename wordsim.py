@@ -2,28 +2,127 @@
 # coding: utf8
 
 import os
+import re
+import glob
+import time
+import hashlib
 import logging
 import argparse
-from scipy import linalg, stats
+import contextlib
+from scipy import stats
 import csv
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from prettytable import PrettyTable
-from extramodules.embeddings import WordEmbeddings
+from extramodules.embeddings import WordEmbeddings, SentenceEmbeddings, LazyWordEmbeddings, is_stream
+from extramodules.vocabulary import Vocabulary
+from extramodules.similarity import (embedding_matrix, similarity_matrix, paired_similarity, spearman_rows,
+                                     knn_statistics, batch_spearman, batch_kendall, randomized_svd,
+                                     prefix_similarities, SIMILARITIES)
+from extramodules.freqindex import FrequencyIndex, frequency_bins
+from extramodules.pairtable import PairTable
+from extramodules.atomicdir import file_signature
+
+
+DIM_REDUCTIONS = ('svd', 'truncate')
+
+
+def bins_type(value):
+    """ Parses either a number of quantile bins or comma-separated bin edges ('500,' for a single edge) """
+    if ',' not in value:
+        return int(value)
+    edges = [float(edge) for edge in value.split(',') if edge.strip()]
+    if not edges:
+        raise argparse.ArgumentTypeError("no bin edge in '{}'".format(value))
+    return sorted(edges)
 
 
 def argparser():
     parser = argparse.ArgumentParser()
     parser.add_argument('dataset', help="Path to the CSV dataset")
     parser.add_argument('embeddings', nargs='+',
-                        help="Path to the embedding model")
+                        help="Path to the embedding model, to a directory of models or glob pattern. "
+                             "Use '-' or a named pipe to read a model as it is written")
     parser.add_argument('-w', '--wordset',
                         help="Path to a wordset used to filter the used embeddings.")
     parser.add_argument('-o', '--output_csv',
                         help="Path to the output CSV file")
+    parser.add_argument('--stream', action='store_true',
+                        help="Evaluate the models one at a time, loading the next model while the current one is evaluated. "
+                             "Only the main results are computed and they are appended to the output CSV file "
+                             "(--random_pairs, --folds, the frequency bins and --dims can't be used)")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep watching the embeddings directories and patterns and evaluate new models "
+                             "as they are written (implies --stream)")
+    parser.add_argument('--poll_interval', type=float, default=10,
+                        help="Seconds between two scans of the watched directories (default: 10)")
+    parser.add_argument('-s', '--sentences', action='store_true',
+                        help="The embedding files contain phrase embeddings (phrase and vector separated by a tab)")
+    parser.add_argument('-c', '--cache_dir',
+                        help="Directory used to cache the loaded embeddings in a binary format")
+    parser.add_argument('--lazy', action='store_true',
+                        help="Only read the lines of the needed words, using a byte-offset index built next to "
+                             "each embedding file. Gzipped files can't be indexed: they are loaded entirely")
+    parser.add_argument('--similarity', default='cosine', choices=SIMILARITIES,
+                        help="Similarity measure: cosine (default), dot, euclidean (negated distance) or csls. "
+                             "CSLS needs the whole vocabulary of each model, so it can't be used with --lazy")
+    parser.add_argument('--csls_k', type=int, default=10,
+                        help="Number of nearest neighbours used by CSLS (default: 10)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of threads used to compute the Kendall taus and the nearest neighbours of CSLS")
+    parser.add_argument('-r', '--random_pairs', type=int, default=0,
+                        help="Number of random prime/target re-pairings used to compute a chance baseline")
+    parser.add_argument('--baseline_csv',
+                        help="Path to the output CSV file of the random-pair baseline")
+    parser.add_argument('--seed', type=int,
+                        help="Seed of the random re-pairings and of the randomized SVD of --dims")
+    parser.add_argument('--target_freqs',
+                        help="Path to the SPP target item file, used with --prime_freqs to evaluate by frequency bins")
+    parser.add_argument('--prime_freqs',
+                        help="Path to the SPP prime item file, used with --target_freqs to evaluate by frequency bins")
+    parser.add_argument('--freq_cache',
+                        help="Path to the cache of the frequency index (default: next to the target item file)")
+    parser.add_argument('--freq_bins', type=bins_type, default=4,
+                        help="Number of quantile frequency bins (default: 4) or comma-separated bin edges. "
+                             "A single edge is given with a trailing comma: '500,' is two bins split at 500, "
+                             "while '500' is 500 quantile bins")
+    parser.add_argument('--freq_csv',
+                        help="Path to the output CSV file of the evaluation by frequency bins")
+    parser.add_argument('-f', '--folds', nargs='+',
+                        help="Paths to the fold files (data/folds/fold_*.csv) used for a cross-validated evaluation")
+    parser.add_argument('--fold_jobs', type=int, default=1,
+                        help="Number of folds evaluated in parallel")
+    parser.add_argument('--folds_csv',
+                        help="Path to the output CSV file of the cross-validated evaluation")
+    parser.add_argument('--dims', type=int, nargs='+',
+                        help="Also evaluate the models reduced to each of these numbers of dimensions "
+                             "(not available with csls)")
+    parser.add_argument('--dim_reduction', default='svd', choices=DIM_REDUCTIONS,
+                        help="How the models are reduced: projection on the right singular vectors of the "
+                             "uncentered vectors of the dataset words (svd, default; not a PCA) "
+                             "or first coordinates (truncate)")
+    parser.add_argument('--dims_csv',
+                        help="Path to the output CSV file of the evaluation by number of dimensions")
     parser.add_argument('-l', '--logger', default='INFO',
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
                         help="Logging level: DEBUG, INFO (default), WARNING, ERROR")
 
     args = parser.parse_args()
+    if args.dims is not None and args.similarity == 'csls':
+        parser.error("--dims can't be used with the csls similarity")
+    if args.lazy and args.similarity == 'csls':
+        parser.error("--lazy can't be used with the csls similarity")
+    if (args.target_freqs is None) != (args.prime_freqs is None):
+        parser.error("--target_freqs and --prime_freqs must be given together")
+    if args.baseline_csv is not None and args.random_pairs <= 0:
+        parser.error("--baseline_csv needs --random_pairs")
+    if args.stream or args.watch:
+        # Streamed models are only evaluated on the whole dataset
+        for option, used in (('--random_pairs', args.random_pairs > 0), ('--folds', args.folds is not None),
+                             ('--target_freqs', args.target_freqs is not None),
+                             ('--prime_freqs', args.prime_freqs is not None), ('--dims', args.dims is not None)):
+            if used:
+                parser.error("{} can't be used with --stream or --watch".format(option))
 
     numeric_level = getattr(logging, args.logger.upper(), None)
     if not isinstance(numeric_level, int):
@@ -33,33 +132,19 @@ def argparser():
     return args
 
 
-def load_dataset(filename):
-    header = {}
-    dataset = []
-    with open(filename, "r") as csv_in:
-        csv_reader = csv.DictReader(csv_in)
-        header = csv_reader.fieldnames
-
-        for row in csv_reader:
-            dataset.append(row)
-
-    return dataset, header
+def load_dataset(filename, fold_files=None):
+    """ Loads the pair table of a CSV dataset, built and saved next to it by the first call (see PairTable.open).
+    The pairs are assigned to the given fold files.
+    """
+    dataset = PairTable.open(filename, fold_files=fold_files)
+    return dataset, dataset.meta['header']
 
 
 def load_wordset(filename):
-    wordset = set()
-    with open(filename, "r") as fin:
-        for line in fin:
-            line = line.rstrip("\r\n")
-            if not line:  # Don't add empty lines to the wordset
-                continue
-            wordset.add(line)
-
-    return wordset
-
-
-def cosine_similarity(vec1, vec2):
-    return vec1.dot(vec2) / (linalg.norm(vec1) * linalg.norm(vec2))
+    """ Loads a wordset from a file with one word per line or from a saved Vocabulary directory """
+    if Vocabulary.is_saved(filename):
+        return Vocabulary.load(filename)
+    return Vocabulary.from_file(filename)
 
 
 def spearman_rho(vec1, vec2):
@@ -74,35 +159,317 @@ def pearson(vec1, vec2):
     return stats.stats.pearsonr(vec1, vec2)
 
 
-def evaluate(dataset, header, word2vec):
-    pred, label = [], []
-    found, notfound = 0, 0
+def index_pairs(dataset):
+    """ Maps every (prime, target) pair of the dataset (PairTable or list of CSV rows) to integer ids.
+
+    Returns:
+      (words, prime_ids, target_ids, rts): Lowercased vocabulary of the dataset, ids of the primes and targets
+      in this vocabulary and RTs (NaN when the RT is missing)
+    """
+    if isinstance(dataset, PairTable):
+        return dataset.index()
+
+    vocab = {}
+    prime_ids = np.empty(len(dataset), dtype=np.int64)
+    target_ids = np.empty(len(dataset), dtype=np.int64)
+    rts = np.empty(len(dataset), dtype=np.float64)
 
-    for data in dataset:
-        w1 = data['prime'].lower()
-        w2 = data['target'].lower()
+    for i, data in enumerate(dataset):
+        prime_ids[i] = vocab.setdefault(data['prime'].lower(), len(vocab))
+        target_ids[i] = vocab.setdefault(data['target'].lower(), len(vocab))
         try:
-            rt = float(data['rt'])
+            rts[i] = float(data['rt'])
         except ValueError:
-            notfound += 1
-            continue
-        if w1 in word2vec and w2 in word2vec:
-            found += 1
-            pred.append(cosine_similarity(word2vec[w1], word2vec[w2]))
-            label.append(rt)
-        else:
-            notfound += 1
+            rts[i] = np.nan
+
+    return list(vocab), prime_ids, target_ids, rts
+
 
-    rho, pr = spearman_rho(label, pred)
-    tau, pt = kendall_tau(label, pred)
+def predict_pairs(words, prime_ids, target_ids, word2vec, similarity='cosine', knn=None):
+    """ Computes the similarity of every indexed pair in one vectorized pass (NaN when a word is missing).
+    For CSLS, knn maps each word to its mean similarity to its nearest neighbours.
+    """
+    matrix, found = embedding_matrix(words, word2vec)
 
-    result = (rho, pr, tau, pt, found, notfound)
+    pred = np.full(len(prime_ids), np.nan)
+    mask = found[prime_ids] & found[target_ids]
+    primes, targets = prime_ids[mask], target_ids[mask]
+    knn_primes, knn_targets = None, None
+    if knn is not None:
+        knn = np.array([knn.get(word, np.nan) for word in words])
+        knn_primes, knn_targets = knn[primes], knn[targets]
+    pred[mask] = paired_similarity(matrix[primes], matrix[targets], similarity, knn_primes, knn_targets)
+
+    return pred
+
+
+def knn_cache_path(cache_dir, filename, k, wordset_filename=None):
+    """ Path of the cache of the nearest neighbour statistics of a model.
+    The statistics depend on the wordset, so the key includes its signature.
+    """
+    wordset_signature = file_signature(wordset_filename) if wordset_filename is not None else None
+    digest = hashlib.sha1("{}\n{}\n".format(file_signature(filename),
+                                            wordset_signature).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "{}.{}.knn{}.npz".format(os.path.basename(filename), digest, k))
+
+
+def masked_correlations(rts, pred, mask):
+    """ Returns (rho, rho p-value, tau, tau p-value, found) on the pairs selected by mask """
+    rho, pr = spearman_rho(rts[mask], pred[mask])
+    tau, pt = kendall_tau(rts[mask], pred[mask])
+    return rho, pr, tau, pt, int(mask.sum())
+
+
+def evaluate_batch(dataset, word2vecs, similarity='cosine', knns=None, jobs=1):
+    """ Evaluates all the models against the same indexed pairs of the dataset.
+
+    The predictions of the models form a (models x pairs) matrix. The Spearman correlations of all the models
+    are computed with matrix operations, the Kendall taus are computed by a pool of threads.
+
+    Args:
+      word2vecs (dict): Models by name
+      knns (dict): For CSLS, nearest neighbour statistics of each model (see predict_pairs)
+
+    Returns:
+      (results, preds): (rho, rho p-value, tau, tau p-value, found, not found) of each model
+                        (see RESULTS_HEADER) and predictions of each model
+    """
+    words, prime_ids, target_ids, rts = index_pairs(dataset)
+    names = list(word2vecs)
+    matrix = np.empty((len(names), len(prime_ids)))
+    for i, name in enumerate(names):
+        knn = knns.get(name) if knns is not None else None
+        matrix[i] = predict_pairs(words, prime_ids, target_ids, word2vecs[name], similarity, knn)
+
+    rho, pr, found = batch_spearman(matrix, rts)
+    tau, pt = batch_kendall(matrix, rts, jobs=jobs)
+
+    results = {}
+    for i, name in enumerate(names):
+        results[name] = (rho[i], pr[i], tau[i], pt[i], int(found[i]), len(dataset) - int(found[i]))
+
+    return results, dict(zip(names, matrix))
+
+
+def evaluate_dimensions(dataset, word2vec, dims, reduction='svd', similarity='cosine', seed=None, jobs=1):
+    """ Evaluates a model reduced to each of the given numbers of dimensions, without building the reduced models.
+
+    With 'truncate', a model reduced to d dimensions keeps the first d coordinates of its vectors.
+    With 'svd', the vectors of the words of the dataset are projected once on their max(dims) first
+    right singular vectors, found with a randomized SVD: a model reduced to d dimensions keeps the first
+    d coordinates of this projection. The vectors are not centered, so that the projection on all the
+    dimensions is a rotation, which keeps the similarities of the model (unlike a PCA).
+    The similarities of all the dimensions are computed in one pass on the prefixes of the vectors.
+
+    Returns:
+      dict: Results of each number of dimensions (same as evaluate_batch)
+    """
+    words, prime_ids, target_ids, rts = index_pairs(dataset)
+    matrix, found = embedding_matrix(words, word2vec, dtype=np.float64)
+
+    max_dim = matrix.shape[1]
+    if reduction == 'svd':
+        max_dim = min(max_dim, int(found.sum()))
+    skipped = [dim for dim in dims if not 0 < dim <= max_dim]
+    if skipped:
+        logging.warning("Dimensions %s skipped: the model can be reduced to at most %d dimensions", skipped, max_dim)
+    dims = [dim for dim in dims if 0 < dim <= max_dim]
+    if not dims:
+        return {}
+
+    if reduction == 'svd':
+        u, s, vt = randomized_svd(matrix[found], max(dims), rng=np.random.default_rng(seed))
+        matrix = np.zeros((len(words), len(s)))
+        matrix[found] = u * s
+
+    mask = found[prime_ids] & found[target_ids]
+    preds = np.full((len(dims), len(prime_ids)), np.nan)
+    preds[:, mask] = prefix_similarities(matrix[prime_ids[mask]], matrix[target_ids[mask]], dims, similarity)
+
+    rho, pr, found_pairs = batch_spearman(preds, rts)
+    tau, pt = batch_kendall(preds, rts, jobs=jobs)
+
+    results = {}
+    for i, dim in enumerate(dims):
+        results[dim] = (rho[i], pr[i], tau[i], pt[i], int(found_pairs[i]), len(dataset) - int(found_pairs[i]))
+    return results
 
-    return result
+
+def evaluate_frequency_bins(dataset, preds, freq_index, bins):
+    """ Evaluates every model on each frequency bin of the dataset, given the predictions of each model
+    (see evaluate_batch).
+    The frequency of a pair is the sum of the frequencies of its prime and its target.
+
+    Returns:
+      dict: For each model, list of (min freq, max freq, rho, rho p-value, tau, tau p-value, found) per bin
+    """
+    words, prime_ids, target_ids, rts = index_pairs(dataset)
+    words = np.array(words, dtype=str)
+    freqs = freq_index.pair_frequencies(words[prime_ids], words[target_ids])
+    bin_ids, edges = frequency_bins(freqs, bins)
+
+    results = {}
+    for name, pred in preds.items():
+        valid = ~np.isnan(pred) & ~np.isnan(rts)
+        results[name] = []
+        for i in range(len(edges) - 1):
+            results[name].append((edges[i], edges[i + 1]) + masked_correlations(rts, pred, valid & (bin_ids == i)))
+
+    return results
+
+
+def evaluate_folds(dataset, preds, folds, n_folds, jobs=1):
+    """ Evaluates every model on each fold of the dataset (PairTable), given the predictions of each model
+    (see evaluate_batch).
+    Each fold is selected with a mask.
+
+    Args:
+      folds (np.ndarray): Fold of each pair, -1 for the pairs in none of the folds (see PairTable.pair_folds)
+      n_folds (int): Number of folds
+
+    Returns:
+      dict: For each model, list of (rho, rho p-value, tau, tau p-value, found) per fold
+    """
+    rts = np.asarray(dataset.rts)
+
+    executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    results = {}
+    for name, pred in preds.items():
+        valid = ~np.isnan(pred) & ~np.isnan(rts)
+        masks = [valid & (folds == fold) for fold in range(n_folds)]
+        if executor is not None:
+            results[name] = list(executor.map(lambda mask: masked_correlations(rts, pred, mask), masks))
+        else:
+            results[name] = [masked_correlations(rts, pred, mask) for mask in masks]
+    if executor is not None:
+        executor.shutdown()
+
+    return results
+
+
+def random_pair_baseline(dataset, word2vec, n_pairings, seed=None, block_size=256, similarity='cosine', knn=None):
+    """ Compares the Spearman correlation of a model with the correlations obtained
+    when the primes are randomly re-paired with the targets.
+
+    The similarities between all the words of the dataset are computed once,
+    the re-pairings are then scored by indexing into this matrix.
+
+    Returns:
+      (rho, mean, std, p, found): Correlation of the original pairs, mean and standard deviation
+      of the correlations of the re-pairings, permutation p-value and number of pairs used
+    """
+    words, prime_ids, target_ids, rts = index_pairs(dataset)
+    matrix, found = embedding_matrix(words, word2vec)
+    mask = found[prime_ids] & found[target_ids] & ~np.isnan(rts)
+    primes, targets, label = prime_ids[mask], target_ids[mask], rts[mask]
+
+    if knn is not None:
+        knn = np.array([knn.get(word, np.nan) for word in words])
+    sim = similarity_matrix(matrix, similarity, knn)
+    rho = spearman_rows(sim[primes, targets][np.newaxis], label)[0]
+
+    rng = np.random.default_rng(seed)
+    rhos = np.empty(n_pairings)
+    for start in range(0, n_pairings, block_size):
+        size = min(block_size, n_pairings - start)
+        shuffled = rng.permuted(np.tile(primes, (size, 1)), axis=1)
+        rhos[start:start + size] = spearman_rows(sim[shuffled, targets], label)
+
+    p = (1 + np.sum(np.abs(rhos) >= abs(rho))) / (1 + n_pairings)
+
+    return rho, rhos.mean(), rhos.std(), p, len(label)
+
+
+# Files written next to the models: offset indexes of --lazy (see build_offset_index) and their locks
+SIDECAR_PATTERN = re.compile(r"\.idx(\.[^/]*)?$|\.lock$")
+
+
+def expand_embeddings(paths):
+    """ Expands the directories and glob patterns into a list of embedding files.
+    The sidecar files of the models (see SIDECAR_PATTERN) are skipped.
+    """
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                    if os.path.isfile(os.path.join(path, name))
+                                    and not SIDECAR_PATTERN.search(name)))
+        elif any(char in path for char in "*?["):
+            filenames.extend(sorted(filename for filename in glob.glob(path)
+                                    if not SIDECAR_PATTERN.search(filename)))
+        else:
+            filenames.append(path)
+
+    return filenames
+
+
+def close_model(word2vec):
+    """ Closes the embedding file of a lazily loaded model """
+    if isinstance(word2vec, LazyWordEmbeddings):
+        word2vec.close()
+
+
+def model_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def stream_models(filenames, load_model, skip_errors=False):
+    """ Yields the (filename, model) of each file. The next model is loaded in a background thread
+    while the current one is used, so at most two models are in memory at the same time.
+    With skip_errors, the models that can't be loaded are logged and skipped.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(load_model, filenames[0]) if filenames else None
+        for i, filename in enumerate(filenames):
+            try:
+                model = future.result()
+            except Exception:
+                if not skip_errors:
+                    raise
+                logging.exception("Can't load '%s', skipping it", filename)
+                model = None
+            future = executor.submit(load_model, filenames[i + 1]) if i + 1 < len(filenames) else None
+            if model is not None:
+                yield filename, model
+            del model
+
+
+# Files being written by a training job, which are renamed once complete
+PARTIAL_SUFFIXES = (".tmp", ".part")
+
+
+def watch_models(paths, poll_interval):
+    """ Yields the new embedding files matched by paths as they appear.
+    A file is considered complete once its size didn't change between two scans.
+    Temporary files (see PARTIAL_SUFFIXES) and files that disappear during the scan are skipped.
+    """
+    done = set()
+    sizes = {}
+    while True:
+        ready = []
+        for filename in expand_embeddings(paths):
+            if filename in done or filename.endswith(PARTIAL_SUFFIXES):
+                continue
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                sizes.pop(filename, None)
+                continue
+            if size > 0 and sizes.get(filename) == size:
+                ready.append(filename)
+                done.add(filename)
+            sizes[filename] = size
+        if ready:
+            yield ready
+        else:
+            time.sleep(poll_interval)
+
+
+RESULTS_HEADER = ["Embeddings", "rho", "rho p-value", "tau", "tau p-value", "Found", "Not Found"]
 
 
 def print_results(results):
-    table = PrettyTable(["Embeddings", "rho", "rho p-value", "tau", "tau p-value", "Found", "Not Found"])
+    table = PrettyTable(RESULTS_HEADER)
     table.align["Embeddings"] = "l"
 
     for key, value in results.items():
@@ -115,39 +482,271 @@ def dump_results(output, results):
         writer = csv.writer(csv_out, lineterminator="\n")
 
         rows = []
-        rows.append(["Embeddings", "rho", "rho p-value", "tau", "tau p-value", "Found", "Not Found"])
+        rows.append(RESULTS_HEADER)
         for key, value in results.items():
             rows.append([key, value[0], value[1], value[2], value[3], value[4], value[5]])
 
         writer.writerows(rows)
 
 
+def append_results(output, results):
+    """ Appends the results to a CSV file, writing the header if the file is new """
+    new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+    with open(output, "a") as csv_out:
+        writer = csv.writer(csv_out, lineterminator="\n")
+
+        if new_file:
+            writer.writerow(RESULTS_HEADER)
+        for key, value in results.items():
+            writer.writerow([key] + list(value))
+
+
+BASELINE_HEADER = ["Embeddings", "rho", "baseline rho mean", "baseline rho std", "p-value", "Found"]
+
+
+def print_baseline(baselines):
+    table = PrettyTable(BASELINE_HEADER)
+    table.align["Embeddings"] = "l"
+
+    for key, value in baselines.items():
+        table.add_row([key] + list(value))
+    print(table)
+
+
+def dump_baseline(output, baselines):
+    with open(output, "w") as csv_out:
+        writer = csv.writer(csv_out, lineterminator="\n")
+
+        rows = [BASELINE_HEADER]
+        for key, value in baselines.items():
+            rows.append([key] + list(value))
+
+        writer.writerows(rows)
+
+
+FREQ_HEADER = ["Embeddings", "min freq", "max freq", "rho", "rho p-value", "tau", "tau p-value", "Found"]
+
+
+def print_frequency_bins(results):
+    table = PrettyTable(FREQ_HEADER)
+    table.align["Embeddings"] = "l"
+
+    for key, rows in results.items():
+        for row in rows:
+            table.add_row([key] + list(row))
+    print(table)
+
+
+def dump_frequency_bins(output, results):
+    with open(output, "w") as csv_out:
+        writer = csv.writer(csv_out, lineterminator="\n")
+
+        rows = [FREQ_HEADER]
+        for key, value in results.items():
+            rows.extend([key] + list(row) for row in value)
+
+        writer.writerows(rows)
+
+
+FOLDS_HEADER = ["Embeddings", "fold", "rho", "rho p-value", "tau", "tau p-value", "Found"]
+
+
+def fold_rows(results):
+    """ Rows with the results of each fold followed by the mean and standard deviation over the folds """
+    rows = []
+    for key, value in results.items():
+        rows.extend([key, fold] + list(row) for fold, row in enumerate(value))
+        values = np.array(value, dtype=np.float64)
+        rho, tau, found = values[:, 0], values[:, 2], values[:, 4]
+        rows.append([key, "mean", np.nanmean(rho), "", np.nanmean(tau), "", int(found.sum())])
+        rows.append([key, "std", np.nanstd(rho), "", np.nanstd(tau), "", ""])
+    return rows
+
+
+def print_folds(results):
+    table = PrettyTable(FOLDS_HEADER)
+    table.align["Embeddings"] = "l"
+
+    for row in fold_rows(results):
+        table.add_row(row)
+    print(table)
+
+
+def dump_folds(output, results):
+    with open(output, "w") as csv_out:
+        writer = csv.writer(csv_out, lineterminator="\n")
+
+        writer.writerow(FOLDS_HEADER)
+        writer.writerows(fold_rows(results))
+
+
+DIMS_HEADER = ["Embeddings", "dims", "rho", "rho p-value", "tau", "tau p-value", "Found", "Not Found"]
+
+
+def print_dimensions(results):
+    table = PrettyTable(DIMS_HEADER)
+    table.align["Embeddings"] = "l"
+
+    for key, value in results.items():
+        for dim, row in value.items():
+            table.add_row([key, dim] + list(row))
+    print(table)
+
+
+def dump_dimensions(output, results):
+    with open(output, "w") as csv_out:
+        writer = csv.writer(csv_out, lineterminator="\n")
+
+        writer.writerow(DIMS_HEADER)
+        for key, value in results.items():
+            for dim, row in value.items():
+                writer.writerow([key, dim] + list(row))
+
+
 def main():
     args = argparser()
 
-    dataset, header = load_dataset(args.dataset)
+    dataset, header = load_dataset(args.dataset, fold_files=args.folds)
     wordset = None
     if args.wordset is not None:
         wordset = load_wordset(args.wordset)
 
-    # Loading all word embedding models
-    word2vecs = {}
-    for filename in args.embeddings:
+    phrases = None
+    if args.sentences:
+        phrases = set(index_pairs(dataset)[0])
+
+    # Streamed models are read in a single pass: only the vectors of the dataset words are kept,
+    # unless CSLS needs the whole vocabulary
+    stream_wordset = None
+    if args.similarity != 'csls':
+        stream_wordset = Vocabulary.from_words(index_pairs(dataset)[0])
+        if wordset is not None:
+            stream_wordset = stream_wordset.intersection(wordset)
+    else:
+        stream_wordset = wordset
+
+    def load_model(filename):
         logging.info("Loading word embeddings from '{}'...".format(filename))
-        word2vec = WordEmbeddings(filename, wordset=wordset).load()
+        if args.lazy and filename.endswith(".gz"):
+            logging.warning("'%s' is gzipped and can't be indexed: it is loaded entirely", filename)
+        if args.sentences:
+            word2vec = SentenceEmbeddings(filename, lowercase=True, sentenceset=phrases,
+                                          cache_dir=args.cache_dir).load()
+        elif is_stream(filename):
+            word2vec = WordEmbeddings(filename, wordset=stream_wordset).load()
+        elif args.lazy and not filename.endswith(".gz"):
+            word2vec = LazyWordEmbeddings(filename, wordset=wordset)
+        else:
+            word2vec = WordEmbeddings(filename, wordset=wordset, cache_dir=args.cache_dir).load()
         logging.info("Loaded {} word embeddings.".format(len(word2vec)))
-        word2vecs[filename] = word2vec
-
-    results = {}
-    for filename in args.embeddings:
-        word2vec = word2vecs[filename]
-        basename = os.path.basename(filename)
-        results[os.path.splitext(basename)[0]] = evaluate(dataset, header, word2vec)
-
-    print_results(results)
+        return word2vec
+
+    def model_knn(filename, word2vec):
+        """ Nearest neighbour statistics of the words of the dataset, needed by CSLS """
+        if args.similarity != 'csls':
+            return None
+        words = index_pairs(dataset)[0]
+        cache_path = None
+        if args.cache_dir is not None and not is_stream(filename):
+            os.makedirs(args.cache_dir, exist_ok=True)
+            cache_path = knn_cache_path(args.cache_dir, filename, args.csls_k, args.wordset)
+        return dict(zip(words, knn_statistics(words, word2vec, k=args.csls_k, cache_path=cache_path, jobs=args.jobs)))
+
+    if args.stream or args.watch:
+        if args.watch:
+            batches = watch_models(args.embeddings, args.poll_interval)
+        else:
+            batches = [expand_embeddings(args.embeddings)]
+        # Models already in the output file are not evaluated again
+        recorded = set()
+        if args.output_csv is not None and os.path.exists(args.output_csv):
+            with open(args.output_csv, "r") as csv_in:
+                recorded = {row[RESULTS_HEADER[0]] for row in csv.DictReader(csv_in)}
+
+        results = {}
+        try:
+            for filenames in batches:
+                filenames = [filename for filename in filenames if model_name(filename) not in recorded]
+                for filename, word2vec in stream_models(filenames, load_model, skip_errors=args.watch):
+                    name = model_name(filename)
+                    try:
+                        result, _ = evaluate_batch(dataset, {name: word2vec}, args.similarity,
+                                                   {name: model_knn(filename, word2vec)}, jobs=args.jobs)
+                    except Exception:
+                        # A broken model must not stop the watch
+                        if not args.watch:
+                            raise
+                        logging.exception("Can't evaluate '%s', skipping it", filename)
+                        continue
+                    finally:
+                        close_model(word2vec)
+                    rho, pr, tau, pt, found, notfound = result[name]
+                    logging.info("%s: rho=%f tau=%f found=%d", filename, rho, tau, found)
+                    if args.output_csv is not None:
+                        append_results(args.output_csv, result)
+                    results.update(result)
+        except KeyboardInterrupt:
+            logging.info("Stopped watching.")
+        print_results(results)
+        return
+
+    embeddings = expand_embeddings(args.embeddings)
+
+    # The files of the lazily loaded models are closed once every evaluation is done
+    with contextlib.ExitStack() as stack:
+        # Loading all word embedding models
+        word2vecs = {}
+        for filename in embeddings:
+            word2vecs[filename] = load_model(filename)
+            stack.callback(close_model, word2vecs[filename])
+
+        models = {}
+        knns = {}
+        for filename in embeddings:
+            models[model_name(filename)] = word2vecs[filename]
+            knns[model_name(filename)] = model_knn(filename, word2vecs[filename])
+
+        results, preds = evaluate_batch(dataset, models, args.similarity, knns, jobs=args.jobs)
+
+        baselines = {}
+        if args.random_pairs > 0:
+            for name, word2vec in models.items():
+                baselines[name] = random_pair_baseline(dataset, word2vec, args.random_pairs, seed=args.seed,
+                                                       similarity=args.similarity, knn=knns[name])
+
+        print_results(results)
+        if baselines:
+            print_baseline(baselines)
+
+        freq_results = None
+        if args.target_freqs is not None:
+            freq_index = FrequencyIndex.load(args.target_freqs, args.prime_freqs, cache_path=args.freq_cache)
+            freq_results = evaluate_frequency_bins(dataset, preds, freq_index, args.freq_bins)
+            print_frequency_bins(freq_results)
+
+        fold_results = None
+        if args.folds is not None:
+            fold_results = evaluate_folds(dataset, preds, dataset.pair_folds(args.folds), len(args.folds),
+                                          jobs=args.fold_jobs)
+            print_folds(fold_results)
+
+        dim_results = None
+        if args.dims is not None:
+            dim_results = {name: evaluate_dimensions(dataset, word2vec, args.dims, args.dim_reduction, args.similarity,
+                                                     seed=args.seed, jobs=args.jobs)
+                           for name, word2vec in models.items()}
+            print_dimensions(dim_results)
 
     if args.output_csv is not None:
         dump_results(args.output_csv, results)
+    if args.freq_csv is not None and freq_results is not None:
+        dump_frequency_bins(args.freq_csv, freq_results)
+    if args.folds_csv is not None and fold_results is not None:
+        dump_folds(args.folds_csv, fold_results)
+    if args.dims_csv is not None and dim_results is not None:
+        dump_dimensions(args.dims_csv, dim_results)
+    if args.baseline_csv is not None and baselines:
+        dump_baseline(args.baseline_csv, baselines)
 
 
 if __name__ == '__main__':